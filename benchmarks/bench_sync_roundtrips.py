@@ -0,0 +1,105 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2015 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Counts the remote round-trips (ref advertisements) that a single update
+# through core.sync costs. Every round-trip spawns one receive-pack or
+# upload-pack on the remote end, which we pick up from git's trace output.
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+from benchmarks.harness import git
+from propagator.core.sync import mirror_sync, restricted_sync
+
+def make_source(path, branches, tags):
+    git("init", "-q", path)
+    git("commit", "-q", "--allow-empty", "-m", "init", cwd = path)
+    for i in range(branches):
+        git("branch", "branch-{}".format(i), cwd = path)
+    for i in range(tags):
+        git("tag", "tag-{}".format(i), cwd = path)
+
+    # a ref outside heads and tags, which a restricted sync must not push
+    git("update-ref", "refs/pull/1/head", "HEAD", cwd = path)
+
+def count_round_trips(tracefile):
+    count = 0
+    with open(tracefile) as f:
+        for line in f:
+            if "run_command:" in line and ("git-receive-pack" in line or "git-upload-pack" in line):
+                count = count + 1
+    return count
+
+def run_once(syncfunc, src, dest, workdir):
+    tracefile = os.path.join(workdir, "trace.{}".format(time.monotonic_ns()))
+    os.environ["GIT_TRACE"] = tracefile
+    try:
+        start = time.perf_counter()
+        ret = syncfunc(src, dest)
+        elapsed = time.perf_counter() - start
+    finally:
+        del os.environ["GIT_TRACE"]
+    return (ret, count_round_trips(tracefile), elapsed)
+
+def cmdline_process():
+    parser = argparse.ArgumentParser(description = "Count remote round-trips per update in core.sync")
+    parser.add_argument("-b", "--branches", type = int, default = 50, help = "number of branches in the source repository")
+    parser.add_argument("-t", "--tags", type = int, default = 500, help = "number of tags in the source repository")
+    parser.add_argument("-m", "--max-round-trips", type = int, default = 1, help = "fail if an update needs more round-trips than this")
+    return parser.parse_args()
+
+def main():
+    args = cmdline_process()
+    failed = False
+    with tempfile.TemporaryDirectory(prefix = "propagator-bench-") as workdir:
+        src = os.path.join(workdir, "src")
+        make_source(src, args.branches, args.tags)
+
+        for name, syncfunc in (("mirror_sync", mirror_sync), ("restricted_sync", restricted_sync)):
+            dest = os.path.join(workdir, "{}.git".format(name))
+            git("init", "-q", "--bare", dest)
+            for run in ("initial", "noop"):
+                ret, trips, elapsed = run_once(syncfunc, src, dest, workdir)
+                print("{0:16} {1:8} ok={2} round-trips={3} time={4:.3f}s".format(name, run, ret, trips, elapsed))
+                if (not ret) or (trips > args.max_round_trips):
+                    failed = True
+
+        # the restricted mirror must only carry heads and tags
+        dest = os.path.join(workdir, "restricted_sync.git")
+        if git("for-each-ref", "--format=%(refname)", "refs/pull", cwd = dest):
+            print("restricted_sync pushed refs outside heads and tags")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
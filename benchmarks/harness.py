@@ -0,0 +1,241 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2015 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Shared pieces for the benchmarks: generating repositories, counting git
+# processes, timing operations, and a local stand-in for the GitHub API.
+
+import os
+import re
+import json
+import time
+import threading
+import subprocess
+import http.server
+import urllib.parse
+
+from propagator.utils.tracestats import percentile
+
+# Repositories
+
+GIT_IDENT = {
+    "GIT_AUTHOR_NAME": "bench", "GIT_AUTHOR_EMAIL": "bench@localhost",
+    "GIT_COMMITTER_NAME": "bench", "GIT_COMMITTER_EMAIL": "bench@localhost",
+}
+
+def git(*args, cwd = None, stdin = None):
+    env = dict(os.environ, **GIT_IDENT)
+    env.pop("GIT_TRACE", None)
+    return subprocess.run(("git",) + args, cwd = cwd, input = stdin, env = env, check = True,
+        stdout = subprocess.PIPE, stderr = subprocess.DEVNULL).stdout.decode("utf-8").strip()
+
+def make_repo(path, commits = 100, branches = 10, tags = 100, blob_size = 1024):
+    # build a bare repository in one fast-import run. commits form a single
+    # line of history, and branches and tags are spread along it.
+    git("init", "-q", "--bare", path)
+    stream = []
+    for i in range(1, commits + 1):
+        blob = ("{:08d}".format(i) * (blob_size // 8 + 1))[:blob_size]
+        stream.append("blob\nmark :{}\ndata {}\n{}\n".format(i * 2, len(blob), blob))
+        stream.append("commit refs/heads/master\nmark :{}\n".format(i * 2 + 1))
+        stream.append("committer bench <bench@localhost> {} +0000\n".format(1400000000 + i))
+        stream.append("data 10\ncommit {:03d}\n".format(i % 1000))
+        if i > 1:
+            stream.append("from :{}\n".format(i * 2 - 1))
+        stream.append("M 100644 :{} file-{}.txt\n\n".format(i * 2, i % 50))
+    for i in range(branches):
+        stream.append("reset refs/heads/branch-{}\nfrom :{}\n\n".format(i, (i % commits + 1) * 2 + 1))
+    for i in range(tags):
+        stream.append("reset refs/tags/v{}\nfrom :{}\n\n".format(i, (i % commits + 1) * 2 + 1))
+    git("fast-import", "--quiet", cwd = path, stdin = "".join(stream).encode("utf-8"))
+    return path
+
+def add_commit(path, ref = "refs/heads/master"):
+    # put one new commit on top of a ref, outside of any measurement
+    parent = git("rev-parse", ref, cwd = path)
+    tree = git("rev-parse", "{}^{{tree}}".format(ref), cwd = path)
+    commit = git("commit-tree", tree, "-p", parent, "-m", "bench {}".format(time.time()), cwd = path)
+    git("update-ref", ref, commit, cwd = path)
+    return commit
+
+# Measurements
+
+class GitCounter(object):
+    # counts the git processes started while it is active. every git process
+    # writes exactly one "built-in" or "exec" line to the trace file.
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.count = 0
+
+    def __enter__(self):
+        self.path = os.path.join(self.workdir, "trace.{}".format(time.monotonic_ns()))
+        self.previous = os.environ.get("GIT_TRACE")
+        os.environ["GIT_TRACE"] = self.path
+        return self
+
+    def __exit__(self, *exc):
+        if self.previous is None:
+            del os.environ["GIT_TRACE"]
+        else:
+            os.environ["GIT_TRACE"] = self.previous
+        try:
+            with open(self.path) as f:
+                self.count = sum(1 for line in f if ("trace: built-in:" in line) or ("trace: exec:" in line))
+            os.unlink(self.path)
+        except FileNotFoundError:
+            self.count = 0
+        return False
+
+def summarise(timings, counts):
+    result = {
+        "n": len(timings),
+        "mean": sum(timings) / len(timings),
+        "p50": percentile(timings, 50),
+        "p90": percentile(timings, 90),
+        "p99": percentile(timings, 99),
+        "max": max(timings),
+    }
+    for name, values in counts.items():
+        result[name] = sum(values) / len(values)
+    return result
+
+def measure(workdir, func, iterations, setup = None, counters = None):
+    # run func the given number of times, with an optional untimed setup
+    # step before each run, and summarise the latencies, the git process
+    # count, and any extra cumulative counters (name -> callable) per run
+    counters = counters or {}
+    timings = []
+    counts = { "git_processes": [] }
+    counts.update((name, []) for name in counters)
+    for i in range(iterations):
+        if setup:
+            setup()
+        before = { name: get() for name, get in counters.items() }
+        with GitCounter(workdir) as counter:
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        counts["git_processes"].append(counter.count)
+        for name, get in counters.items():
+            counts[name].append(get() - before[name])
+    return summarise(timings, counts)
+
+# GitHub API stand-in
+
+class GitHubStubHandler(http.server.BaseHTTPRequestHandler):
+    PAGE_SIZE = 100
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body = None, headers = None):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("X-RateLimit-Limit", "5000")
+        self.send_header("X-RateLimit-Remaining", "4999")
+        self.send_header("X-RateLimit-Reset", str(int(time.time()) + 3600))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        self.server.calls = self.server.calls + 1
+        url = urllib.parse.urlsplit(self.path)
+        if re.match(r"^/orgs/[^/]+/repos$", url.path):
+            query = urllib.parse.parse_qs(url.query)
+            page = int(query.get("page", ["1"])[0])
+            names = sorted(self.server.repos)
+            chunk = names[(page - 1) * self.PAGE_SIZE:page * self.PAGE_SIZE]
+            headers = {}
+            if page * self.PAGE_SIZE < len(names):
+                nexturl = "{}{}?per_page={}&page={}".format(self.server.url, url.path, self.PAGE_SIZE, page + 1)
+                headers["Link"] = '<{}>; rel="next"'.format(nexturl)
+            return self.reply(200, [self.server.repos[i] for i in chunk], headers)
+        m = re.match(r"^/repos/[^/]+/(.+)$", self.path)
+        if m and (m.group(1) in self.server.repos):
+            meta = self.server.repos[m.group(1)]
+            etag = '"{}"'.format(meta["id"])
+            if self.headers.get("If-None-Match") == etag:
+                return self.reply(304)
+            return self.reply(200, meta, { "ETag": etag })
+        return self.reply(404, { "message": "Not Found" })
+
+    def do_POST(self):
+        self.server.calls = self.server.calls + 1
+        payload = self.body()
+        meta = self.server.add(payload["name"], payload.get("description"))
+        return self.reply(201, meta)
+
+    def do_PATCH(self):
+        self.server.calls = self.server.calls + 1
+        m = re.match(r"^/repos/[^/]+/(.+)$", self.path)
+        if not (m and (m.group(1) in self.server.repos)):
+            return self.reply(404, { "message": "Not Found" })
+        payload = self.body()
+        meta = self.server.repos.pop(m.group(1))
+        meta.update(payload)
+        self.server.repos[meta["name"]] = meta
+        return self.reply(200, meta)
+
+    def do_DELETE(self):
+        self.server.calls = self.server.calls + 1
+        m = re.match(r"^/repos/[^/]+/(.+)$", self.path)
+        if m and self.server.repos.pop(m.group(1), None):
+            return self.reply(204)
+        return self.reply(404, { "message": "Not Found" })
+
+class GitHubStub(http.server.ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), GitHubStubHandler)
+        self.repos = {}
+        self.calls = 0
+        self.next_id = 1
+        self.thread = threading.Thread(target = self.serve_forever, daemon = True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def add(self, name, desc = None):
+        meta = { "id": self.next_id, "name": name, "description": desc }
+        self.next_id = self.next_id + 1
+        self.repos[name] = meta
+        return meta
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
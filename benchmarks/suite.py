@@ -0,0 +1,311 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2015 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Offline micro-benchmarks for core.sync, the GitHub remote plugin,
+# SlaveCore and the anongit agent's startup. Everything runs against
+# generated local repositories, file:// destinations and a local stand-in
+# for the GitHub API, inside a throwaway HOME, so no broker, network or
+# existing configuration is needed.
+#
+#   python -m benchmarks.suite -o results.json
+#   python -m benchmarks.suite -c results.json
+
+import os
+import sys
+import json
+import time
+import types
+import argparse
+import platform
+import tempfile
+import subprocess
+import threading
+
+from benchmarks.harness import git, make_repo, add_commit, measure, GitHubStub
+
+def write_config(home, repobase):
+    cfgdir = os.path.join(home, ".propagator")
+    os.makedirs(cfgdir)
+    with open(os.path.join(cfgdir, "propagator.cfg"), "w") as f:
+        f.write("[general]\n")
+        f.write("repobase={}\n".format(repobase))
+        f.write("logs_dir={}\n".format(os.path.join(home, "logs")))
+        f.write("cache_dir={}\n".format(os.path.join(home, "cache")))
+        f.write("workers=1\n")
+        f.write("[metrics]\nport=0\n")
+    with open(os.path.join(cfgdir, "anongit.cfg"), "w") as f:
+        f.write("[anongit]\nrepobase={}\n".format(repobase))
+    with open(os.path.join(cfgdir, "remotes_github.json"), "w") as f:
+        json.dump({ "organization": "bench", "access_token": "bench", "excepts": [] }, f)
+
+def stub_remote_class(stub, destbase):
+    # the github plugin, pointed at the api stand-in and at local mirrors
+    from propagator.remotes import github
+
+    class Remote(github.Remote):
+        ENDPOINT_REPO = "{}/repos".format(stub.url)
+        ENDPOINT_ORGS = "{}/orgs".format(stub.url)
+
+        def remote_url(self, name):
+            return "file://{}".format(os.path.join(destbase, name))
+
+    return Remote
+
+# Scenarios
+
+def bench_sync(workdir, src, iterations):
+    from propagator.core.sync import mirror_sync, restricted_sync
+
+    results = {}
+    for name, syncfunc in (("mirror", mirror_sync), ("restricted", restricted_sync)):
+        dests = []
+        def fresh_dest():
+            path = os.path.join(workdir, "dest-{}-{}.git".format(name, len(dests)))
+            git("init", "-q", "--bare", path)
+            dests.append("file://{}".format(path))
+        results["sync.{}.initial".format(name)] = measure(workdir, lambda: syncfunc(src, dests[-1]), iterations, fresh_dest)
+        results["sync.{}.noop".format(name)] = measure(workdir, lambda: syncfunc(src, dests[-1]), iterations)
+        results["sync.{}.incremental".format(name)] = measure(workdir, lambda: syncfunc(src, dests[-1]), iterations, lambda: add_commit(src))
+    return results
+
+def bench_github(workdir, stub, destbase, iterations):
+    import logbook
+    Remote = stub_remote_class(stub, destbase)
+    calls = { "api_calls": lambda: stub.calls }
+
+    results = {}
+    results["github.plugin_init"] = measure(workdir, lambda: Remote(logbook.Logger("bench")), iterations, counters = calls)
+    remote = Remote(logbook.Logger("bench"))
+    stub.add("exists")
+
+    results["github.repo_exists.cold"] = measure(workdir, lambda: remote._repo_exists("exists"), iterations, lambda: remote.cache.drop("exists"), calls)
+    results["github.repo_exists.cached"] = measure(workdir, lambda: remote._repo_exists("exists"), iterations, counters = calls)
+
+    def expire():
+        entry = remote.cache.get("exists")
+        if entry:
+            entry["expires"] = 0
+    results["github.repo_exists.revalidate"] = measure(workdir, lambda: remote._repo_exists("exists"), iterations, expire, calls)
+
+    names = iter(range(10 ** 9))
+    current = []
+    def next_name():
+        current[:] = ["bench-{}".format(next(names))]
+    results["github.create"] = measure(workdir, lambda: remote.create(current[0], "bench"), iterations, next_name, calls)
+    results["github.setdesc"] = measure(workdir, lambda: remote.setdesc(current[0], "bench {}".format(time.time())), iterations, counters = calls)
+
+    def make_victim():
+        next_name()
+        stub.add(current[0])
+    results["github.rename"] = measure(workdir, lambda: remote.rename(current[0], current[0] + "-renamed"), iterations, make_victim, calls)
+    results["github.delete"] = measure(workdir, lambda: remote.delete(current[0]), iterations, make_victim, calls)
+    return results
+
+class FakeConnection(object):
+    def __init__(self, channel):
+        self.channel = channel
+
+    def add_callback_threadsafe(self, callback):
+        callback()
+
+    def process_data_events(self, time_limit = None):
+        pass
+
+class FakeChannel(object):
+    # just enough of a pika channel for SlaveCore, signalling every ack
+    def __init__(self):
+        self.connection = FakeConnection(self)
+        self.acked = threading.Event()
+
+    def basic_qos(self, **kwargs):
+        pass
+
+    def basic_consume(self, *args, **kwargs):
+        pass
+
+    def basic_ack(self, delivery_tag):
+        self.acked.set()
+
+    def basic_publish(self, **kwargs):
+        pass
+
+def bench_slave(workdir, stub, repobase, destbase, iterations):
+    from propagator.remoteslave import amqp
+    from propagator.remoteslave.slavecore import SlaveCore
+
+    # register the stubbed plugin under its own name, and keep the slave off
+    # the broker
+    module = types.ModuleType("propagator.remotes.benchstub")
+    module.Remote = stub_remote_class(stub, destbase)
+    sys.modules[module.__name__] = module
+    amqp.create_channel_consumer = lambda slave_name, *args: FakeChannel()
+
+    slave = SlaveCore("benchstub")
+    channel = slave.channel
+    method = types.SimpleNamespace(delivery_tag = 1)
+    calls = { "api_calls": lambda: stub.calls }
+
+    def process(message):
+        body = json.dumps(message).encode("utf-8")
+        def run():
+            channel.acked.clear()
+            slave.process_single_message(channel, method, None, body)
+            channel.acked.wait()
+        return run
+
+    src = os.path.join(repobase, "bench.git")
+    update = process({ "operation": "update", "repository": "bench.git" })
+    results = {}
+    results["slave.update.initial"] = measure(workdir, update, 1, counters = calls)
+    results["slave.update.noop"] = measure(workdir, update, iterations, counters = calls)
+    results["slave.update.incremental"] = measure(workdir, update, iterations, lambda: add_commit(src), calls)
+
+    # the same, with the message saying which ref moved
+    changes = []
+    def move_master():
+        old = git("rev-parse", "refs/heads/master", cwd = src)
+        changes[:] = [{ "old": old, "new": add_commit(src), "ref": "refs/heads/master" }]
+    update_delta = lambda: process({ "operation": "update", "repository": "bench.git", "refs": changes })()
+    results["slave.update.delta"] = measure(workdir, update_delta, iterations, move_master, calls)
+    results["slave.syncdesc"] = measure(workdir, process({ "operation": "syncdesc", "repository": "bench.git" }), iterations, counters = calls)
+    results["slave.malformed"] = measure(workdir, process({ "operation": "bogus", "repository": "bench.git" }), iterations, counters = calls)
+    slave.pool.shutdown(wait = True)
+    return results
+
+def bench_agent(workdir, repobase, iterations):
+    # the agent is started afresh for every ssh connection to a mirror, so
+    # what matters is interpreter startup plus imports, up to the exec of
+    # git-shell. each run is a new process, compared against bare python and
+    # against git-shell doing the same ref advertisement on its own.
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    modules = { "count": 0 }
+
+    def python(code, command = None):
+        def run():
+            env = dict(os.environ, PYTHONPATH = root)
+            if command:
+                env["SSH_ORIGINAL_COMMAND"] = command
+            p = subprocess.run((sys.executable, "-c", code), env = env, cwd = workdir,
+                stdin = subprocess.DEVNULL, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL)
+            if code.startswith("import sys"):
+                modules["count"] = modules["count"] + int(p.stdout)
+        return run
+
+    def git_shell():
+        command = "git-upload-pack '{}'".format(os.path.join(repobase, "bench.git"))
+        subprocess.run(("git-shell", "-c", command), stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+    # the import run reports how many modules the agent pulled in
+    count_imports = "import sys; before = set(sys.modules); import propagator.agent; print(len(set(sys.modules) - before))"
+    upload_pack = "git-upload-pack 'bench.git'"
+    calls = { "modules": lambda: modules["count"] }
+    results = {}
+    results["agent.python"] = measure(workdir, python("pass"), iterations)
+    results["agent.import"] = measure(workdir, python(count_imports), iterations, counters = calls)
+    results["agent.upload_pack"] = measure(workdir, python("from propagator.agent import main; main()", upload_pack), iterations)
+    results["agent.upload_pack.git_shell"] = measure(workdir, git_shell, iterations)
+    return results
+
+# Reporting
+
+def print_results(results, baseline = None):
+    print("{:36} {:>9} {:>9} {:>9} {:>9} {:>6} {:>6}".format("operation", "p50 ms", "p90 ms", "p99 ms", "mean ms", "git", "api"))
+    for name in sorted(results):
+        r = results[name]
+        line = "{:36} {:9.2f} {:9.2f} {:9.2f} {:9.2f} {:6.1f} {:>6}".format(
+            name, r["p50"] * 1000, r["p90"] * 1000, r["p99"] * 1000, r["mean"] * 1000,
+            r["git_processes"], "{:.1f}".format(r["api_calls"]) if "api_calls" in r else "-")
+        if baseline and (name in baseline) and baseline[name]["p50"]:
+            line = line + "  {:+6.1f}% p50".format((r["p50"] / baseline[name]["p50"] - 1) * 100)
+        print(line)
+
+def cmdline_process():
+    parser = argparse.ArgumentParser(description = "Run the Propagator micro-benchmarks")
+    parser.add_argument("-n", "--iterations", type = int, default = 20, help = "runs per operation")
+    parser.add_argument("--commits", type = int, default = 200, help = "commits in the generated repository")
+    parser.add_argument("--branches", type = int, default = 20, help = "branches in the generated repository")
+    parser.add_argument("--tags", type = int, default = 200, help = "tags in the generated repository")
+    parser.add_argument("--blob-size", type = int, default = 1024, help = "size of each generated file version in bytes")
+    parser.add_argument("-s", "--scenario", action = "append", choices = ("sync", "github", "slave", "agent"), help = "only run these scenarios")
+    parser.add_argument("-o", "--output", type = str, help = "write the results as json to this file")
+    parser.add_argument("-c", "--compare", type = str, help = "compare against the results in this json file")
+    return parser.parse_args()
+
+def main():
+    args = cmdline_process()
+    scenarios = args.scenario or ("sync", "github", "slave", "agent")
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    with tempfile.TemporaryDirectory(prefix = "propagator-bench-") as workdir:
+        # propagator reads its configuration from HOME at import time
+        repobase = os.path.join(workdir, "repos")
+        destbase = os.path.join(workdir, "mirrors")
+        os.makedirs(destbase)
+        os.environ["HOME"] = workdir
+        write_config(workdir, repobase)
+
+        src = make_repo(os.path.join(repobase, "bench.git"), args.commits, args.branches, args.tags, args.blob_size)
+        git("init", "-q", "--bare", os.path.join(destbase, "bench.git"))
+
+        stub = GitHubStub()
+        for i in range(250):
+            stub.add("warm-{}".format(i))
+        results = {}
+        try:
+            if "sync" in scenarios:
+                results.update(bench_sync(workdir, src, args.iterations))
+            if "github" in scenarios:
+                results.update(bench_github(workdir, stub, destbase, args.iterations))
+            if "slave" in scenarios:
+                results.update(bench_slave(workdir, stub, repobase, destbase, args.iterations))
+            if "agent" in scenarios:
+                results.update(bench_agent(workdir, repobase, args.iterations))
+        finally:
+            stub.stop()
+
+    report = {
+        "meta": {
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "git": git("--version"),
+            "parameters": vars(args),
+        },
+        "results": results,
+    }
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent = 4, sort_keys = True)
+
+if __name__ == "__main__":
+    main()
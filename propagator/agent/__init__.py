@@ -31,10 +31,7 @@ import os
 import sys
 import shlex
 
-from . import config
-from . import repo
 from . import gitcmd
-from . import control
 
 def main():
     cmd = os.environ.get("SSH_ORIGINAL_COMMAND")
@@ -44,13 +41,16 @@ def main():
 
     entry = shlex.split(cmd)[0]
     if entry == "anongitctl":
+        # every clone and fetch runs through here, so the control commands'
+        # imports (GitPython among them) are only paid for when they're used
+        from . import control
         if not control.handle_command(cmd):
             print("FAIL")
             sys.exit(192)
         print("OK")
         sys.exit(0)
     elif entry in ("git-receive-pack", "git-upload-pack", "git-upload-archive"):
-        gitcmd.handle_command(cmd)
-        sys.exit(192)
+        status = gitcmd.handle_command(cmd)
+        sys.exit(192 if status is False else status)
     else:
         print("ERROR: Invalid command. This account does not provide shell access", file = sys.stderr)
@@ -0,0 +1,187 @@
+# This file is part of Propagator, a KDE project
+#
+# Copyright 2016 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Archive cache for upload-archive. Release tooling and packagers ask for the
+# same tarball of the same tag over and over, so the agent answers
+# upload-archive itself. It reads the client's arguments, and the complete
+# response git sends back for them is cached under the repository, the
+# resolved object, the format, the prefix and whatever paths were asked
+# for. Repeat requests are then sent straight from the cache file with
+# sendfile(), never passing through userspace. The response includes the
+# file list that -v sends on the progress band, so -v is part of the key.
+#
+# A commit's id and date end up in the archive, so the key uses the commit
+# when there is one, and the tree only when the client asked for a tree.
+
+import os
+import sys
+import hashlib
+import subprocess
+
+from . import config
+from . import diskcache
+
+# options that change the response but take no value
+FLAG_OPTIONS = ("-0", "-1", "-2", "-3", "-4", "-5", "-6", "-7", "-8", "-9", "-v", "--worktree-attributes")
+
+def read_request(fd):
+    # the client sends its arguments as "argument <arg>" pkt-lines followed
+    # by a flush. we keep the raw bytes so they can be replayed to git.
+    raw = bytearray()
+    args = []
+
+    def read_exactly(count):
+        data = bytearray()
+        while len(data) < count:
+            chunk = os.read(fd, count - len(data))
+            if not chunk:
+                return None
+            data.extend(chunk)
+        return bytes(data)
+
+    while True:
+        header = read_exactly(4)
+        if header is None:
+            return (bytes(raw), None)
+        raw.extend(header)
+        try:
+            length = int(header, 16)
+        except ValueError:
+            return (bytes(raw), None)
+        if length == 0:
+            return (bytes(raw), args)
+        if length < 4:
+            return (bytes(raw), None)
+        payload = read_exactly(length - 4)
+        if payload is None:
+            return (bytes(raw), None)
+        raw.extend(payload)
+        line = payload.decode("utf-8", "replace").rstrip("\n")
+        if not line.startswith("argument "):
+            return (bytes(raw), None)
+        args.append(line[len("argument "):])
+
+def parse_args(args):
+    # returns (format, prefix, options, treeish, paths), or None for anything
+    # we don't understand well enough to cache, which is then left to git
+    fmt = "tar"
+    prefix = ""
+    options = []
+    treeish = None
+    paths = []
+
+    for arg in args:
+        if treeish is not None:
+            paths.append(arg)
+        elif arg.startswith("--format="):
+            fmt = arg.split("=", 1)[1]
+        elif arg.startswith("--prefix="):
+            prefix = arg.split("=", 1)[1]
+        elif arg == "--verbose":
+            options.append("-v")
+        elif arg in FLAG_OPTIONS:
+            options.append(arg)
+        elif arg.startswith("-"):
+            return None
+        else:
+            treeish = arg
+    if treeish is None:
+        return None
+    return (fmt, prefix, sorted(set(options)), treeish, paths)
+
+def git_output(repopath, *args):
+    try:
+        out = subprocess.check_output(("git", "--git-dir", repopath) + args, stderr = subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return None
+    return out.decode("utf-8").strip()
+
+def resolve(repopath, treeish):
+    # upload-archive only hands out objects reachable from a ref by name,
+    # so we only answer from the cache when the client named a ref too
+    ref, sep, path = treeish.partition(":")
+    if not git_output(repopath, "rev-parse", "--symbolic-full-name", "--verify", ref):
+        return None
+    obj = git_output(repopath, "rev-parse", "--verify", "{}^{{commit}}".format(ref))
+    if not obj:
+        obj = git_output(repopath, "rev-parse", "--verify", "{}^{{tree}}".format(ref))
+    if not obj:
+        return None
+    return obj + sep + path
+
+def cache_key(repopath, obj, request):
+    fmt, prefix, options, treeish, paths = request
+    digest = hashlib.sha256()
+    for item in [os.path.realpath(repopath), obj, fmt, prefix] + options + ["--"] + paths:
+        digest.update(item.encode("utf-8") + b"\0")
+    return digest.hexdigest()
+
+def pinned_request(args, treeish, obj):
+    # the request again, with the ref the client named replaced by the
+    # object it resolved to, so the archive built is the one the key says
+    lines = ["argument {}\n".format(obj if arg == treeish else arg).encode("utf-8") for arg in args]
+    return b"".join(b"%04x" % (len(i) + 4) + i for i in lines) + b"0000"
+
+def run_archiver(repopath, raw, out, pinned = False):
+    # run upload-archive with the request we already read. a pinned request
+    # names an object id, which we've checked is reachable from a ref.
+    command = ["git", "upload-archive", repopath]
+    if pinned:
+        command[1:1] = ["-c", "uploadarchive.allowUnreachable=true"]
+    archiver = subprocess.Popen(command, stdin = subprocess.PIPE, stdout = out)
+    try:
+        archiver.stdin.write(raw)
+        archiver.stdin.close()
+    except BrokenPipeError:
+        pass
+    return archiver.wait()
+
+def upload_archive(repopath):
+    out = sys.stdout.buffer
+    raw, args = read_request(sys.stdin.fileno())
+    request = parse_args(args) if args is not None else None
+    obj = resolve(repopath, request[3]) if request else None
+    if obj is None:
+        out.flush()
+        return run_archiver(repopath, raw, out)
+
+    # the response is written out in full and then sent, so that nobody
+    # waiting on the same archive is held to the speed of the first
+    # client's connection. a failed response is sent too, for its errors.
+    # the ref may move while we build, so the build asks for the object we
+    # resolved rather than the ref, which git archives exactly the same way
+    pinned = pinned_request(args, request[3], obj)
+    def build(f):
+        return run_archiver(repopath, pinned, f, True)
+
+    key = cache_key(repopath, obj, request)
+    entry, status = diskcache.lookup(config.archive_cache_dir(), key, ".archive", config.archive_cache_size(), build)
+    with entry:
+        diskcache.send_file(entry, out)
+    return status
@@ -28,18 +28,61 @@
 # THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import configparser
+import functools
 import os
 
-def repobase():
-    default = os.path.expanduser("~/repositories")
+@functools.lru_cache(maxsize = None)
+def settings():
+    # anongit.cfg is read once per process, however often it's asked about
     cfgpath = os.path.expanduser("~/.propagator/anongit.cfg")
+    config = configparser.ConfigParser()
     try:
-        config = configparser.ConfigParser()
         config.read(cfgpath)
-        path = config["anongit"].get("repobase", default)
-        return os.path.expanduser(path)
-    except:
-        return default
+    except configparser.Error:
+        pass
+    if not config.has_section("anongit"):
+        config.add_section("anongit")
+    return config["anongit"]
+
+def repobase():
+    return os.path.expanduser(settings().get("repobase", "~/repositories"))
+
+def flag(key):
+    try:
+        return settings().getboolean(key, False)
+    except ValueError:
+        return False
+
+def supervise():
+    return flag("supervise")
+
+def megabytes(key, default):
+    # sizes are in megabytes in the config file, in bytes here
+    try:
+        return settings().getint(key, default) * 1024 * 1024
+    except ValueError:
+        return default * 1024 * 1024
+
+def pack_cache():
+    return flag("pack_cache")
+
+def pack_cache_dir():
+    return os.path.expanduser(settings().get("pack_cache_dir", "~/.propagator/packcache"))
+
+def pack_cache_size():
+    return megabytes("pack_cache_size", 2048)
+
+def pack_cache_hook():
+    return settings().get("pack_cache_hook", "propagator-agent-packcache")
+
+def archive_cache():
+    return flag("archive_cache")
+
+def archive_cache_dir():
+    return os.path.expanduser(settings().get("archive_cache_dir", "~/.propagator/archivecache"))
+
+def archive_cache_size():
+    return megabytes("archive_cache_size", 4096)
 
 def translate_path(path):
     path = os.path.normpath(path)
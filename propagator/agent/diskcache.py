@@ -0,0 +1,126 @@
+# This file is part of Propagator, a KDE project
+#
+# Copyright 2016 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Helpers shared by the agent's on-disk response caches. An entry is built
+# once under an exclusive lock on its key, but it's served without any lock
+# held. Readers open a finished entry, and an open file stays readable even
+# if eviction unlinks it in the meantime.
+
+import os
+import glob
+import fcntl
+import tempfile
+
+CHUNK_SIZE = 1024 * 1024
+
+def open_entry(path):
+    try:
+        entry = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return entry
+
+def lookup(cachedir, key, suffix, max_size, build):
+    # returns (file, status). build(f) writes a fresh entry into f and
+    # returns the exit status to report. a failed build's output is handed
+    # back too, so that its errors can still be passed on, but it isn't kept.
+    path = os.path.join(cachedir, key + suffix)
+    entry = open_entry(path)
+    if entry:
+        return (entry, 0)
+
+    os.makedirs(cachedir, exist_ok = True)
+    with open(os.path.join(cachedir, key + ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entry = open_entry(path)
+        if entry:
+            return (entry, 0)
+
+        fd, tmppath = tempfile.mkstemp(dir = cachedir, suffix = ".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                status = build(f)
+            if status == 0:
+                os.replace(tmppath, path)
+                entry = open(path, "rb")
+            else:
+                entry = open(tmppath, "rb")
+        finally:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+    if status == 0:
+        evict(cachedir, max_size, suffix)
+    return (entry, status)
+
+def send_file(entry, out):
+    # sendfile() keeps the data out of userspace. not every output supports
+    # it, so anything it can't do is copied by hand.
+    out.flush()
+    outfd = out.fileno()
+    size = os.fstat(entry.fileno()).st_size
+    offset = 0
+    try:
+        while offset < size:
+            sent = os.sendfile(outfd, entry.fileno(), offset, size - offset)
+            if not sent:
+                break
+            offset = offset + sent
+    except OSError:
+        entry.seek(offset)
+        while True:
+            chunk = entry.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+        out.flush()
+
+def evict(cachedir, max_size, suffix):
+    # least recently served first. entries are touched whenever served,
+    # and each one's lock file goes with it.
+    entries = []
+    for path in glob.glob(os.path.join(cachedir, "*" + suffix)):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(i[1] for i in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        for name in (path, path[:-len(suffix)] + ".lock"):
+            try:
+                os.unlink(name)
+            except FileNotFoundError:
+                pass
+        total = total - size
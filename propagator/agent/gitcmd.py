@@ -32,7 +32,6 @@ import os
 import sys
 
 from . import config
-from . import repo
 
 def analyse_command(cmd):
     cmd_parts_old = shlex.split(cmd)
@@ -56,13 +55,38 @@ def handle_command(cmd):
         repopath, cmdstring = analyse_command(cmd)
     except TypeError:
         return False
-    repopath = config.translate_path(repopath)
 
+    # only pushes may need a repository created, and that needs GitPython.
+    # upload-pack and upload-archive go straight to git-shell, unless
+    # they're answered from one of the caches below.
     if cmdstring.startswith("git-receive-pack"):
+        from . import repo
         ret = repo.create(repopath)
         if not ret:
             print("ERROR: The remote repository does not exist and could not be created", file = sys.stderr)
             return False
 
+        # in supervised mode git-shell runs as a child, so that we can see
+        # which refs the push changed and queue the update ourselves
+        if config.supervise():
+            from . import supervise
+            return supervise.receive_pack(repopath, cmdstring)
+
+    # with the archive cache on, we answer upload-archive ourselves
+    if cmdstring.startswith("git-upload-archive") and config.archive_cache():
+        if not os.path.isdir(repopath):
+            print("ERROR: The remote repository does not exist", file = sys.stderr)
+            return False
+        from . import archivecache
+        return archivecache.upload_archive(repopath)
+
+    # upload-pack only honours packObjectsHook from protected config, which
+    # includes config passed in through the environment like this
+    if cmdstring.startswith("git-upload-pack") and config.pack_cache():
+        count = int(os.environ.get("GIT_CONFIG_COUNT", 0))
+        os.environ["GIT_CONFIG_KEY_{}".format(count)] = "uploadpack.packObjectsHook"
+        os.environ["GIT_CONFIG_VALUE_{}".format(count)] = config.pack_cache_hook()
+        os.environ["GIT_CONFIG_COUNT"] = str(count + 1)
+
     args = ["git-shell", "-c", cmdstring]
     os.execvp("git-shell", args)
@@ -0,0 +1,94 @@
+# This file is part of Propagator, a KDE project
+#
+# Copyright 2016 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Pack cache for upload-pack. When it's turned on, the agent points git's
+# uploadpack.packObjectsHook at this helper, so upload-pack runs it in place
+# of pack-objects. The pack depends on nothing but the repository, the
+# pack-objects options and the wants and haves on stdin, plus any tags that
+# get included along the way, so a response is cached under a hash of those
+# and the repository's ref state. Identical requests, like a CI farm cloning
+# the same repository over and over, are then served straight from disk.
+#
+# Only full clones, which send no haves, are cached. Fetches carry each
+# client's own haves, so their requests hardly ever repeat, and caching them
+# would just fill the cache with packs nobody asks for twice. Those are
+# streamed straight through from pack-objects as before.
+
+import os
+import sys
+import hashlib
+import subprocess
+
+from propagator.core.refs import refs_stamp
+from . import config
+from . import diskcache
+
+# options that only change what goes to stderr, not the pack itself
+IGNORED_OPTIONS = ("--progress", "--quiet", "-q", "--all-progress", "--all-progress-implied")
+
+def cache_key(gitdir, args, request):
+    digest = hashlib.sha256()
+    digest.update(os.path.realpath(gitdir).encode("utf-8") + b"\0")
+    digest.update(str(refs_stamp(gitdir)).encode("utf-8") + b"\0")
+    for arg in args:
+        if arg not in IGNORED_OPTIONS:
+            digest.update(arg.encode("utf-8") + b"\0")
+    digest.update(request)
+    return digest.hexdigest()
+
+def has_haves(request):
+    # upload-pack sends the wants, then "--not" and the haves after it
+    lines = request.split(b"\n")
+    if b"--not" not in lines:
+        return False
+    return any(lines[lines.index(b"--not") + 1:])
+
+def main():
+    # upload-pack runs us in the repository, with the pack-objects command
+    # line as our arguments and the request on stdin
+    args = sys.argv[1:]
+    request = sys.stdin.buffer.read()
+    gitdir = os.environ.get("GIT_DIR", ".")
+
+    if has_haves(request):
+        sys.exit(subprocess.run(args, input = request).returncode)
+
+    # the pack is written out in full before anyone is sent it, so that
+    # neither the first client nor the ones waiting on the same pack are
+    # held to the speed of another client's connection. upload-pack keeps
+    # the connection alive in the meantime.
+    def build(f):
+        return subprocess.run(args, input = request, stdout = f).returncode
+
+    key = cache_key(gitdir, args, request)
+    entry, status = diskcache.lookup(config.pack_cache_dir(), key, ".pack", config.pack_cache_size(), build)
+    with entry:
+        if status == 0:
+            diskcache.send_file(entry, sys.stdout.buffer)
+    sys.exit(status)
@@ -0,0 +1,77 @@
+# This file is part of Propagator, a KDE project
+#
+# Copyright 2016 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Supervised receive-pack. Instead of replacing itself with git-shell, the
+# agent runs it as a child with the ssh session's stdio, compares the refs
+# before and after, and queues an update carrying the exact ref changes with
+# the local producer, so mirrors don't have to wait for a hook to fire.
+
+import os
+import sys
+import subprocess
+
+from . import config
+from propagator.core.refs import read_refs
+from propagator.utils.spool import DEFAULT_SOCKET, DEFAULT_SPOOL
+from propagator.utils.enqueue import update_message, enqueue
+
+def ref_changes(before, after):
+    # (old, new, ref) for every ref the push touched, with git's all-zero
+    # object name standing in for a ref that was created or deleted
+    width = len(next(iter(before.values()), None) or next(iter(after.values()), None) or "0" * 40)
+    zero = "0" * width
+    changes = []
+    for ref in sorted(set(before) | set(after)):
+        old = before.get(ref, zero)
+        new = after.get(ref, zero)
+        if old != new:
+            changes.append({ "old": old, "new": new, "ref": ref })
+    return changes
+
+def publish(repopath, changes):
+    settings = config.settings()
+    name = os.path.relpath(repopath, config.repobase())
+    message = update_message(name, refs = changes)
+    try:
+        reply = enqueue(message, settings.get("producer_socket", DEFAULT_SOCKET), settings.get("spool_dir", DEFAULT_SPOOL))
+    except OSError as e:
+        reply = str(e)
+
+    # the push itself went through, so a failure here is only a warning
+    if reply not in ("OK", None):
+        print("WARNING: could not queue the mirror update: {}".format(reply), file = sys.stderr)
+
+def receive_pack(repopath, cmdstring):
+    before = read_refs(repopath)
+    status = subprocess.call(("git-shell", "-c", cmdstring))
+    if status == 0:
+        changes = ref_changes(before, read_refs(repopath))
+        if changes:
+            publish(repopath, changes)
+    return status
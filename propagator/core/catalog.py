@@ -0,0 +1,178 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2015 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# A persistent catalog of the repositories in repobase. It answers the simple
+# questions producers and slaves ask about a repository (does it exist, is it
+# bare, what is its description, does it have branches) from a small sqlite
+# database, and only rescans a repository on disk when its refs, packed-refs,
+# HEAD or description have changed since the last scan.
+
+import os
+import time
+import sqlite3
+import threading
+
+from propagator.core.config import config_general
+from propagator.core.refs import read_refs, refs_stamp, refs_digest
+
+def git_dir_for(path):
+    # returns (gitdir, bare) for a repository, or (None, None)
+    dotgit = os.path.join(path, ".git")
+    if os.path.isfile(os.path.join(dotgit, "HEAD")):
+        return (dotgit, False)
+    if os.path.isfile(os.path.join(path, "HEAD")) and os.path.isdir(os.path.join(path, "objects")):
+        return (path, True)
+    return (None, None)
+
+def find_repos(repobase):
+    # every directory that looks like a bare repository, relative to repobase
+    for root, dirs, files in os.walk(repobase):
+        if ("HEAD" in files) and ("objects" in dirs) and ("refs" in dirs):
+            dirs[:] = []
+            yield os.path.relpath(root, repobase)
+        else:
+            dirs.sort()
+
+def read_description(gitdir):
+    try:
+        with open(os.path.join(gitdir, "description")) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def objects_size(gitdir):
+    size = 0
+    for root, dirs, files in os.walk(os.path.join(gitdir, "objects")):
+        for filename in files:
+            try:
+                size = size + os.lstat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+class Catalog(object):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS repos (
+            path        TEXT PRIMARY KEY,
+            bare        INTEGER,
+            description TEXT,
+            ref_digest  TEXT,
+            has_heads   INTEGER,
+            size        INTEGER,
+            stamp       INTEGER,
+            scanned_at  REAL
+        )
+    """
+
+    def __init__(self, dbpath):
+        self.dbpath = os.path.expanduser(dbpath)
+        dbdir = os.path.dirname(self.dbpath)
+        if dbdir and not os.path.isdir(dbdir):
+            os.makedirs(dbdir, exist_ok = True)
+        self.local = threading.local()
+        self.db().execute(self.SCHEMA)
+
+    def db(self):
+        # sqlite connections cannot be shared between threads
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.dbpath, timeout = 30, isolation_level = None)
+            conn.row_factory = sqlite3.Row
+            self.local.conn = conn
+        return conn
+
+    def lookup(self, path):
+        # returns a dict describing the repository, or None if there is no
+        # repository at the path
+        gitdir, bare = git_dir_for(path)
+        if not gitdir:
+            self.forget(path)
+            return None
+
+        stamp = refs_stamp(gitdir)
+        row = self.db().execute("SELECT * FROM repos WHERE path = ?", (path,)).fetchone()
+        if row and (row["stamp"] == stamp):
+            entry = dict(row)
+        else:
+            entry = self.scan(path, gitdir, bare, stamp)
+        entry["gitdir"] = gitdir
+        return entry
+
+    def scan(self, path, gitdir, bare, stamp):
+        refs = read_refs(gitdir)
+        entry = {
+            "path": path,
+            "bare": bare,
+            "description": read_description(gitdir),
+            "ref_digest": refs_digest(refs),
+            "has_heads": any(i.startswith("refs/heads/") for i in refs),
+            "size": None,
+            "stamp": stamp,
+            "scanned_at": time.time(),
+        }
+        self.db().execute(
+            "INSERT OR REPLACE INTO repos VALUES (:path, :bare, :description, :ref_digest, :has_heads, :size, :stamp, :scanned_at)",
+            entry
+        )
+        return entry
+
+    def size(self, path):
+        # the size of the object store means walking every object, so it's
+        # left out of scans and only worked out when someone asks for it.
+        # it's kept until the refs change and the entry is scanned again.
+        entry = self.lookup(path)
+        if not entry:
+            return None
+        if entry["size"] is None:
+            entry["size"] = objects_size(entry["gitdir"])
+            self.db().execute("UPDATE repos SET size = ? WHERE path = ?", (entry["size"], path))
+        return entry["size"]
+
+    def forget(self, path):
+        self.db().execute("DELETE FROM repos WHERE path = ?", (path,))
+
+    def set_description(self, path, desc):
+        gitdir, bare = git_dir_for(path)
+        if not gitdir:
+            return False
+        with open(os.path.join(gitdir, "description"), "w") as f:
+            print(desc.strip(), file = f)
+        self.lookup(path)
+        return True
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+def catalog():
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            default = os.path.join(config_general.get("cache_dir", "~/.propagator/cache"), "catalog.sqlite")
+            _catalog = Catalog(config_general.get("catalog_path", default))
+    return _catalog
@@ -59,3 +59,18 @@ try:
     config_amqp = CONFIG_CFGP["amqp"]
 except KeyError:
     config_amqp = {}
+
+try:
+    config_producer = CONFIG_CFGP["producer"]
+except KeyError:
+    config_producer = {}
+
+try:
+    config_metrics = CONFIG_CFGP["metrics"]
+except KeyError:
+    config_metrics = {}
+
+try:
+    config_maintenance = CONFIG_CFGP["maintenance"]
+except KeyError:
+    config_maintenance = {}
@@ -0,0 +1,93 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2016 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Reading ref state straight from the repository files. This module is used
+# by the agent's helpers as well, and must stay cheap to import. Do not pull
+# in GitPython or the core config.
+
+import os
+import hashlib
+
+def read_refs(gitdir):
+    # read the refs straight from packed-refs and the loose ref files. loose
+    # refs win over packed ones, and symbolic refs are left out.
+    refs = {}
+    try:
+        with open(os.path.join(gitdir, "packed-refs")) as f:
+            for line in f:
+                if line.startswith(("#", "^")):
+                    continue
+                sha, _, name = line.strip().partition(" ")
+                if name:
+                    refs[name] = sha
+    except FileNotFoundError:
+        pass
+
+    refsdir = os.path.join(gitdir, "refs")
+    for root, dirs, files in os.walk(refsdir):
+        for filename in files:
+            if filename.endswith(".lock"):
+                continue
+            path = os.path.join(root, filename)
+            try:
+                with open(path) as f:
+                    sha = f.read(41).strip()
+            except OSError:
+                continue
+            if len(sha) == 40:
+                name = os.path.relpath(path, gitdir).replace(os.sep, "/")
+                refs[name] = sha
+    return refs
+
+def refs_stamp(gitdir):
+    # updating a loose ref renames a lock file over it, which touches the
+    # directory it lives in, so the newest directory mtime under refs/
+    # together with the mtimes of a few files tells us if anything changed.
+    #
+    # a ref like refs/heads/work/foo only touches its own directory, so
+    # every directory has to be looked at, and listing them costs about a
+    # microsecond per loose ref: 0.06 ms for a fully packed repository, and
+    # 6 to 10 ms with 10000 loose refs. this is not independent of the
+    # number of refs, but propagator-maintain packs refs once more than
+    # loose_refs of them pile up, which keeps it close to the packed case.
+    stamp = 0
+    for name in ("packed-refs", "HEAD", "description"):
+        try:
+            stamp = max(stamp, os.stat(os.path.join(gitdir, name)).st_mtime_ns)
+        except FileNotFoundError:
+            pass
+    for root, dirs, files in os.walk(os.path.join(gitdir, "refs")):
+        stamp = max(stamp, os.stat(root).st_mtime_ns)
+    return stamp
+
+def refs_digest(refs):
+    digest = hashlib.sha1()
+    for name in sorted(refs):
+        digest.update("{} {}\n".format(refs[name], name).encode("utf-8"))
+    return digest.hexdigest()
@@ -27,29 +27,267 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
 # THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import re
+import os
 import git
+import time
+import shlex
+import shutil
+import hashlib
+import tempfile
+import contextlib
+import subprocess
+import concurrent.futures
 
-def _sync(src, dest, restricted = False, reftypes = ()):
+from propagator.core.config import config_general
+from propagator.core.refs import read_refs
+from propagator.core import tracing
+from propagator.core.tracing import span
+from propagator.core.transport import transport, ssh_host
+
+# callables that are handed a dict of statistics after every push
+_push_observers = []
+add_push_observer = lambda func: _push_observers.append(func)
+
+SIZE_UNITS = { "bytes": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3 }
+
+class _PushProgress(git.RemoteProgress):
+    # picks the amount of data sent out of git's "Writing objects" progress
+    def __init__(self):
+        super().__init__()
+        self.bytes = 0
+
+    def update(self, op_code, cur_count, max_count = None, message = ""):
+        if ((op_code & self.OP_MASK) != self.WRITING) or not message:
+            return
+        m = re.search(r"([\d.]+) (bytes|KiB|MiB|GiB)", message)
+        if m:
+            self.bytes = int(float(m.group(1)) * SIZE_UNITS[m.group(2)])
+
+def _notify(stats):
+    for func in _push_observers:
+        func(stats)
+
+def _has_refs(repo, namespaces = ()):
+    # check the local refs under the given namespaces without touching the remote
+    prefixes = tuple(ns + "/" for ns in namespaces)
+    return any(i.startswith(prefixes) for i in read_refs(repo.git_dir))
+
+def _delta_refspecs(repo, changes, namespaces = ()):
+    # push each changed ref from its current local state, leased on the old
+    # value the message says the mirror had. a ref created by the change
+    # is leased on not existing yet.
+    local = read_refs(repo.git_dir)
+    prefixes = tuple(ns + "/" for ns in namespaces)
+    refspecs = []
+    leases = []
+    for change in changes:
+        ref = change["ref"]
+        if (prefixes) and (not ref.startswith(prefixes)):
+            continue
+        if ref in local:
+            refspecs.append("{0}:{0}".format(ref))
+        else:
+            refspecs.append(":{}".format(ref))
+        old = change["old"] if change["old"].strip("0") else ""
+        leases.append("{}:{}".format(ref, old))
+    return refspecs, leases
+
+def _sync(src, dest, restricted = False, namespaces = (), changes = None):
     repo = git.Repo(src)
+    try:
+        return _push(repo, dest, restricted, namespaces, changes)
+    finally:
+        # don't leave persistent cat-file helpers behind in long-running slaves
+        repo.close()
+
+@contextlib.contextmanager
+def _use_transport(repo, dest):
+    # send pushes to ssh hosts over the pooled master connections, and hold
+    # on to the master until the push is done
+    ssh = transport()
+    target = ssh_host(dest) if ssh else None
+    if target is None:
+        yield
+        return
+    base = repo.git.environment().get("GIT_SSH_COMMAND") or os.environ.get("GIT_SSH_COMMAND")
+    with span("sync.connect"):
+        up = ssh.acquire(target[0], target[1], shlex.split(base) if base else None)
+    try:
+        if up:
+            repo.git.update_environment(GIT_SSH_COMMAND = ssh.git_ssh_command(base))
+        yield
+    finally:
+        ssh.release(target[0], target[1])
+
+def _push(repo, dest, restricted, namespaces, changes = None):
+    with _use_transport(repo, dest):
+        return _push_refs(repo, dest, restricted, namespaces, changes)
+
+def _push_refs(repo, dest, restricted, namespaces, changes):
     remote = git.Remote(repo, dest)
 
+    # a restricted sync only force-pushes the given ref namespaces, and
+    # prunes refs in them that we don't have, like a mirror push. we build
+    # wildcard refspecs from the local ref state, so that git resolves them
+    # against the single ref advertisement it receives for the real push,
+    # instead of doing a separate dry run round-trip to work them out.
     refs = []
-    if (restricted):
-        ret = remote.push(("--mirror", "--dry-run"))
-        for info in ret:
-            # check if the local ref is either a head or a tag
-            if type(info.local_ref) in reftypes:
-                refs.append("".join(("+", info.local_ref.name, ":", info.remote_ref_string)))
-
-    ret = None
-    if (refs):
-        ret = remote.push(refs)
-    else:
-        ret = remote.push("--mirror")
-    for info in ret:
-        if  (info.flags & git.PushInfo.ERROR):
-            return False
-    return True
-
-mirror_sync = lambda src, dest: _sync(src, dest)
-restricted_sync = lambda src, dest: _sync(src, dest, True, (git.refs.Head, git.refs.TagReference))
+    if (restricted) and _has_refs(repo, namespaces):
+        refs = ["".join(("+", ns, "/*:", ns, "/*")) for ns in namespaces]
+
+    progress = _PushProgress() if _push_observers else None
+    stats = { "destination": remote.name, "ok": False, "bytes": 0 }
+    start = time.monotonic()
+    try:
+        ret = None
+        with span("sync.push"):
+            # when we know which refs changed, push only those. if the mirror
+            # doesn't hold the old values we expect, a lease is rejected and
+            # we fall back to syncing everything.
+            if changes is not None:
+                delta, leases = _delta_refspecs(repo, changes, namespaces if restricted else ())
+                if not delta:
+                    stats["ok"] = True
+                    return True
+                ret = remote.push(delta, force_with_lease = leases, progress = progress)
+                if not any(info.flags & git.PushInfo.ERROR for info in ret):
+                    stats["ok"] = True
+                    return True
+            if (refs):
+                ret = remote.push(refs, prune = True, progress = progress)
+            else:
+                ret = remote.push(mirror = True, progress = progress)
+        stats["ok"] = not any(info.flags & git.PushInfo.ERROR for info in ret)
+        return stats["ok"]
+    finally:
+        if progress:
+            stats["duration"] = time.monotonic() - start
+            stats["bytes"] = progress.bytes
+            _notify(stats)
+
+# Fan-out. When a repository goes to several destinations, every push would
+# run its own pack-objects over the same new objects, including a full delta
+# search over any that are still loose. Instead, the objects for the changed
+# range are packed once into a short-lived cache directory, which each push
+# then sees as an alternate object store. pack-objects prefers packed copies
+# and reuses their deltas and compressed data as they are, so what's left to
+# do per destination is mostly copying.
+
+_pack_cache_dir = lambda: os.path.join(os.path.expanduser(config_general.get("cache_dir", "~/.propagator/cache")), "packs")
+_pack_cache_ttl = lambda: int(config_general.get("pack_cache_ttl", 600))
+
+def _expire_packs(cachedir, ttl):
+    now = time.time()
+    for name in os.listdir(cachedir):
+        path = os.path.join(cachedir, name)
+        try:
+            if os.stat(path).st_mtime < now - ttl:
+                shutil.rmtree(path, ignore_errors = True)
+        except FileNotFoundError:
+            pass
+
+def _existing_objects(repo, names):
+    if not names:
+        return []
+    p = subprocess.run(("git", "--git-dir", repo.git_dir, "cat-file", "--batch-check"),
+        input = "".join(i + "\n" for i in names).encode("utf-8"), stdout = subprocess.PIPE, stderr = subprocess.DEVNULL)
+    return [i.split()[0] for i in p.stdout.decode("utf-8").splitlines() if not i.endswith(" missing")]
+
+def _range_pack(repo, changes, namespaces = ()):
+    # pack everything reachable from the changed refs that the mirrors had
+    # not got yet, and return the object directory holding the pack. packs
+    # are shared by everything pushing the same range until they expire.
+    local = read_refs(repo.git_dir)
+    prefixes = tuple(ns + "/" for ns in namespaces)
+    wanted = [i for i in changes if (not prefixes) or i["ref"].startswith(prefixes)]
+    tips = sorted(set(local[i["ref"]] for i in wanted if i["ref"] in local))
+    if not tips:
+        return None
+    excludes = sorted(set(i["old"] for i in wanted if i["old"].strip("0")))
+    excludes = _existing_objects(repo, excludes)
+
+    cachedir = _pack_cache_dir()
+    os.makedirs(cachedir, exist_ok = True)
+    _expire_packs(cachedir, _pack_cache_ttl())
+    key = "\n".join([os.path.realpath(repo.git_dir)] + tips + ["^" + i for i in excludes])
+    objdir = os.path.join(cachedir, hashlib.sha1(key.encode("utf-8")).hexdigest())
+    if os.path.isdir(objdir):
+        os.utime(objdir)
+        return objdir
+
+    # build the pack next to its final place and move it in, so that other
+    # workers and slaves never see a half-written one. the objects are packed
+    # thin, as deltas against what the mirrors already have, like a push
+    # would. index-pack then appends those bases to make a usable pack.
+    tmpdir = tempfile.mkdtemp(dir = cachedir, prefix = ".tmp-")
+    try:
+        packdir = os.path.join(tmpdir, "pack")
+        os.makedirs(packdir)
+        with span("sync.pack"):
+            packer = subprocess.Popen(("git", "--git-dir", repo.git_dir, "pack-objects", "--revs", "--thin", "--stdout", "-q"),
+                stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL)
+            indexer = subprocess.Popen(("git", "--git-dir", repo.git_dir, "index-pack", "--stdin", "--fix-thin", os.path.join(packdir, "tmp.pack")),
+                stdin = packer.stdout, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL)
+            packer.stdout.close()
+            packer.stdin.write("".join(i + "\n" for i in tips + ["^" + i for i in excludes]).encode("utf-8"))
+            packer.stdin.close()
+            output = indexer.communicate()[0].decode("utf-8").split()
+            if packer.wait() or indexer.returncode or (len(output) != 2):
+                raise subprocess.CalledProcessError(packer.returncode or indexer.returncode, "pack-objects")
+        for ext in (".pack", ".idx"):
+            os.rename(os.path.join(packdir, "tmp" + ext), os.path.join(packdir, "pack-{}{}".format(output[1], ext)))
+        os.rename(tmpdir, objdir)
+    except subprocess.CalledProcessError:
+        shutil.rmtree(tmpdir, ignore_errors = True)
+        return None
+    except OSError:
+        # someone else may have packed the same range first, but this is also
+        # where a broken pipe or a full disk ends up
+        shutil.rmtree(tmpdir, ignore_errors = True)
+        if not os.path.isdir(objdir):
+            return None
+    return objdir
+
+def _fanout(src, dests, restricted = False, namespaces = (), changes = None, max_workers = None, env = None):
+    objdir = None
+    if changes:
+        repo = git.Repo(src)
+        try:
+            objdir = _range_pack(repo, changes, namespaces if restricted else ())
+        finally:
+            repo.close()
+
+    trace = tracing.current()
+    def push_one(dest):
+        # every push gets its own repo object, and with it its own environment
+        repo = git.Repo(src)
+        repo.git.update_environment(**(env or {}))
+        if objdir:
+            repo.git.update_environment(GIT_ALTERNATE_OBJECT_DIRECTORIES = objdir)
+        try:
+            with tracing.activate(trace):
+                return _push(repo, dest, restricted, namespaces, changes)
+        finally:
+            repo.close()
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max_workers or len(dests) or 1) as pool:
+        futures = { pool.submit(push_one, dest): dest for dest in dests }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                results[futures[future]] = e
+    return results
+
+# changes, if given, is a list of { "old", "new", "ref" } dicts describing
+# the ref updates since the mirror was last synced
+mirror_sync = lambda src, dest, changes = None: _sync(src, dest, changes = changes)
+restricted_sync = lambda src, dest, changes = None: _sync(src, dest, True, ("refs/heads", "refs/tags"), changes)
+
+# push to several destinations at once. the result maps each destination to
+# True or False, or to the exception its push raised. env, if given, is
+# added to the environment of every push, like a GIT_SSH_COMMAND.
+mirror_fanout = lambda src, dests, changes = None, max_workers = None, env = None: _fanout(src, dests, changes = changes, max_workers = max_workers, env = env)
+restricted_fanout = lambda src, dests, changes = None, max_workers = None, env = None: _fanout(src, dests, True, ("refs/heads", "refs/tags"), changes, max_workers, env)
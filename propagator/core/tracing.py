@@ -0,0 +1,98 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2015 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Lightweight tracing for the slave. A Trace follows one message through the
+# slave and collects timed spans for each stage. The trace being worked on is
+# kept per thread, so code deep inside the remote plugins or core.sync can
+# record spans with tracing.span() without having the trace passed down.
+
+import time
+import uuid
+import threading
+import contextlib
+
+_local = threading.local()
+
+new_trace_id = lambda: uuid.uuid4().hex
+
+class Trace(object):
+    def __init__(self, trace_id = None, start = None):
+        self.trace_id = trace_id or new_trace_id()
+        self.start = start or time.monotonic()
+        self.wallclock = time.time() - (time.monotonic() - self.start)
+        self.outcome = None
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, name, start, end):
+        span = { "name": name, "start": round(start - self.start, 6), "duration": round(end - start, 6) }
+        with self.lock:
+            self.spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.monotonic())
+
+    def record(self, **fields):
+        record = {
+            "trace_id": self.trace_id,
+            "received_at": round(self.wallclock, 6),
+            "total": round(time.monotonic() - self.start, 6),
+            "outcome": self.outcome,
+        }
+        record.update(fields)
+        with self.lock:
+            record["spans"] = list(self.spans)
+        return record
+
+def current():
+    return getattr(_local, "trace", None)
+
+@contextlib.contextmanager
+def activate(trace):
+    previous = current()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+@contextlib.contextmanager
+def span(name):
+    # record a span on the current thread's trace, if there is one
+    trace = current()
+    if trace is None:
+        yield
+        return
+    with trace.span(name):
+        yield
@@ -0,0 +1,183 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2016 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Pooled ssh transport. Every push and remote command to an ssh host goes
+# through one multiplexed OpenSSH master connection per host, so that only
+# the first one pays for the tcp and key exchange handshakes. Masters live
+# on control sockets in a directory of our own, are started up front when a
+# host is first used, checked and restarted by maintain(), and exit once
+# nothing has held them for a while.
+
+import os
+import time
+import shlex
+import threading
+import subprocess
+import urllib.parse
+
+from propagator.core.config import config_general
+
+def ssh_host(url):
+    # the ssh destination and port for a git url, or None if the url isn't
+    # reached over ssh. handles ssh:// urls and scp-like user@host:path.
+    if url.startswith(("ssh://", "git+ssh://", "ssh+git://")):
+        parsed = urllib.parse.urlsplit(url)
+        if not parsed.hostname:
+            return None
+        host = parsed.hostname
+        if parsed.username:
+            host = "{}@{}".format(parsed.username, host)
+        return (host, parsed.port)
+    if "://" in url:
+        return None
+    head, sep, tail = url.partition(":")
+    if (not sep) or (not head) or ("/" in head):
+        return None
+    return (head, None)
+
+class SSHTransport(object):
+    def __init__(self, control_dir, idle_timeout = 300, ssh_command = ("ssh",), connect_timeout = 30):
+        self.control_dir = os.path.expanduser(control_dir)
+        os.makedirs(self.control_dir, mode = 0o700, exist_ok = True)
+        self.idle_timeout = idle_timeout
+        self.ssh_command = tuple(ssh_command)
+        self.connect_timeout = connect_timeout
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def options(self):
+        # with ControlMaster=auto, a session finding no live master simply
+        # becomes one itself, so a master dying never breaks a push. %C is a
+        # hash of the user, host and port, which keeps the socket path short
+        # of the unix socket length limit however long the host name is.
+        return (
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath={}".format(os.path.join(self.control_dir, "%C")),
+            "-o", "ControlPersist={}".format(self.idle_timeout),
+        )
+
+    def command(self, base = None):
+        return tuple(base or self.ssh_command) + self.options()
+
+    def git_ssh_command(self, base = None):
+        # git runs GIT_SSH_COMMAND through the shell
+        base = base or " ".join(shlex.quote(i) for i in self.ssh_command)
+        return " ".join((base,) + tuple(shlex.quote(i) for i in self.options()))
+
+    def _control(self, host, port, *args, base = None):
+        argv = self.command(base) + args
+        if port:
+            argv = argv + ("-p", str(port))
+        try:
+            p = subprocess.run(argv + (host,), stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL,
+                stderr = subprocess.DEVNULL, timeout = self.connect_timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+        return p.returncode == 0
+
+    def check(self, host, port = None, base = None):
+        return self._control(host, port, "-O", "check", base = base)
+
+    def start(self, host, port = None, base = None):
+        # authenticate in the foreground, then leave the master running
+        return self._control(host, port, "-M", "-N", "-f", base = base)
+
+    def _host_entry(self, host, port, base, hold):
+        # make sure a master is up for a host before its first use, so that
+        # concurrent first pushes don't each open a connection of their own
+        with self.lock:
+            entry = self.hosts.get((host, port))
+            if entry is None:
+                entry = self.hosts[(host, port)] = { "lock": threading.Lock(), "used": 0, "active": 0, "base": base, "up": False }
+            entry["used"] = time.monotonic()
+            if hold:
+                entry["active"] = entry["active"] + 1
+        with entry["lock"]:
+            if not entry["up"]:
+                entry["up"] = self.check(host, port, base) or self.start(host, port, base)
+        return entry
+
+    def connect_host(self, host, port = None, base = None):
+        # returns whether a master is up for the host
+        return self._host_entry(host, port, base, False)["up"]
+
+    def acquire(self, host, port = None, base = None):
+        # like connect_host, but the master is also kept from being evicted
+        # as idle until the matching release(), however long its user runs
+        return self._host_entry(host, port, base, True)["up"]
+
+    def release(self, host, port = None):
+        with self.lock:
+            entry = self.hosts.get((host, port))
+            if entry:
+                entry["active"] = entry["active"] - 1
+                entry["used"] = time.monotonic()
+
+    def maintain(self):
+        # evict masters that nobody has used for too long, and restart any
+        # that died under a host that is still in use
+        now = time.monotonic()
+        with self.lock:
+            hosts = list(self.hosts.items())
+        for (host, port), entry in hosts:
+            with entry["lock"]:
+                with self.lock:
+                    idle = (not entry["active"]) and (now - entry["used"] > self.idle_timeout)
+                    if idle:
+                        self.hosts.pop((host, port), None)
+                if idle:
+                    self._control(host, port, "-O", "exit", base = entry["base"])
+                elif not self.check(host, port, entry["base"]):
+                    entry["up"] = self.start(host, port, entry["base"])
+
+    def close(self):
+        with self.lock:
+            hosts = list(self.hosts.items())
+            self.hosts.clear()
+        for (host, port), entry in hosts:
+            self._control(host, port, "-O", "exit", base = entry["base"])
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def transport():
+    # the process-wide transport, or None if pooling is turned off
+    global _transport
+    if config_general.get("ssh_pool", "true").lower() in ("false", "no", "off", "0"):
+        return None
+    with _transport_lock:
+        if _transport is None:
+            default = os.path.join(config_general.get("cache_dir", "~/.propagator/cache"), "ssh")
+            _transport = SSHTransport(
+                config_general.get("ssh_control_dir", default),
+                int(config_general.get("ssh_idle_timeout", 300)),
+                shlex.split(config_general.get("ssh_command", "ssh")),
+                int(config_general.get("ssh_connect_timeout", 30))
+            )
+    return _transport
@@ -0,0 +1,194 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+#   Copyright (C) 2016 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import re
+import os
+import shlex
+import subprocess
+import concurrent.futures
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from propagator.core.sync import mirror_fanout
+from propagator.core.config import config_general
+from propagator.core.tracing import span
+from propagator.core.transport import transport
+from propagator.remotes.remotebase import RemoteBase
+
+class AnongitError(Exception):
+    pass
+
+class Remote(RemoteBase):
+    # mirrors every repository to a fleet of anongit hosts running
+    # propagator-agent. pushes go to all hosts at once, and repository
+    # management is done with the agent's anongitctl commands over ssh.
+
+    # anongitctl output that means the host is already in the state we want
+    # anongit output that means the host is already in the state we want.
+    # a rename only counts as done if the destination is there as well.
+    ALREADY_DONE = {
+        "create": "already exists",
+        "delete": "does not exist",
+        "rename": "Source repo does not exist",
+    }
+
+    @property
+    def plugin_name(self):
+        return "anongit"
+
+    def plugin_init(self, *args, **kwargs):
+        cfgpath = os.path.expanduser("~/.propagator/remotes_anongit.json")
+        with open(cfgpath) as f:
+            cfgdict = json.load(f)
+
+        # hosts are ssh destinations, like anongit@anongit1.example.org. the
+        # url template says how a repository on a host is pushed to.
+        self.hosts = tuple(cfgdict["hosts"])
+        self.url_template = cfgdict.get("url", "{host}:{name}")
+        self.ssh_command = tuple(cfgdict.get("ssh_command", ("ssh", "-o", "BatchMode=yes")))
+        self.except_checks = tuple(re.compile(i) for i in cfgdict.get("excepts", ()))
+        self.routing = tuple(cfgdict.get("routing", ("#",)))
+        self.timeout = int(cfgdict.get("timeout", 120))
+        self.repo_base = config_general.get("repobase")
+
+        # git's pushes have to go through the same ssh command as anongitctl.
+        # core.sync adds the connection pooling options on top of it.
+        self.push_env = { "GIT_SSH_COMMAND": " ".join(shlex.quote(i) for i in self.ssh_command) }
+
+        # anongitctl calls from all workers share one bounded pool, and each
+        # update pushes to at most max_parallel hosts at once
+        self.max_parallel = max(1, int(cfgdict.get("max_parallel", 4)))
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = self.max_parallel)
+        self.logger.info("anongit plugin feeding {} hosts".format(len(self.hosts)))
+
+    def host_url(self, host, name):
+        return self.url_template.format(host = host, name = name)
+
+    def routing_patterns(self):
+        return self.routing
+
+    def remote_url(self, name):
+        return self.host_url(self.hosts[0], name) if self.hosts else None
+
+    def remote_urls(self, name):
+        return [self.host_url(host, name) for host in self.hosts]
+
+    def git_env(self):
+        return self.push_env
+
+    def can_handle_repo(self, name):
+        for i in self.except_checks:
+            if (i.match(name)): return False
+        return True
+
+    def _ctl_one(self, host, args):
+        command = " ".join(shlex.quote(i) for i in ("anongitctl",) + args)
+        ssh_command = self.ssh_command
+        ssh = transport()
+        if ssh and ssh.acquire(host, base = self.ssh_command):
+            ssh_command = ssh.command(self.ssh_command)
+        try:
+            p = subprocess.run(ssh_command + (host, command), stdin = subprocess.DEVNULL,
+                stdout = subprocess.PIPE, stderr = subprocess.STDOUT, timeout = self.timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            return (False, str(e))
+        finally:
+            if ssh:
+                ssh.release(host)
+        output = p.stdout.decode("utf-8", "replace").strip()
+        if p.returncode == 0:
+            return (True, output)
+        done = self.ALREADY_DONE.get(args[0])
+        if (done is None) or (done not in output):
+            return (False, output)
+        if (args[0] == "rename") and not self._exists(host, args[2]):
+            return (False, output)
+        return (True, output)
+
+    def _exists(self, host, name):
+        try:
+            p = subprocess.run(("git", "ls-remote", self.host_url(host, name), "HEAD"), env = dict(os.environ, **self.git_env()),
+                stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, timeout = self.timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+        return p.returncode == 0
+
+    def _ctl(self, *args, hosts = None):
+        # run an anongitctl command on every host, or just on the given ones,
+        # and raise if any failed. returns each host's output.
+        hosts = self.hosts if hosts is None else hosts
+        with span("anongit.{}".format(args[0])):
+            futures = { self.pool.submit(self._ctl_one, host, args): host for host in hosts }
+            results = { futures[i]: i.result() for i in concurrent.futures.as_completed(futures) }
+        failed = sorted(host for host, (ok, output) in results.items() if not ok)
+        for host in failed:
+            self.logger.error("anongitctl {} failed on {}: {}".format(args[0], host, results[host][1].splitlines()[-1:]))
+        if failed:
+            raise AnongitError("anongitctl {} failed on {} of {} hosts: {}".format(args[0], len(failed), len(hosts), ", ".join(failed)))
+        return { host: output for host, (ok, output) in results.items() }
+
+    def create(self, name, desc = "This repository has no description"):
+        # hosts that had the repository already still get the description
+        results = self._ctl("create", name, desc)
+        existing = [host for host, output in results.items() if self.ALREADY_DONE["create"] in output]
+        if existing:
+            self._ctl("setdesc", name, desc, hosts = existing)
+        return True
+
+    def rename(self, name, dest):
+        self._ctl("rename", name, dest)
+        return True
+
+    def delete(self, name):
+        self._ctl("delete", name)
+        return True
+
+    def setdesc(self, name, desc):
+        self._ctl("setdesc", name, desc)
+        return True
+
+    def update(self, repo, name, refs = None):
+        # the agent creates missing repositories on push, so an update never
+        # needs a separate create
+        srcdir = os.path.join(self.repo_base, name)
+        urls = { self.host_url(host, name): host for host in self.hosts }
+        results = mirror_fanout(srcdir, list(urls), refs, self.max_parallel, self.git_env())
+        ok = True
+        for url, result in sorted(results.items()):
+            if result is True:
+                continue
+            ok = False
+            if isinstance(result, Exception):
+                self.logger.error("could not update {} on {}: {}".format(name, urls[url], str(result).strip().splitlines()[-1:]))
+            else:
+                self.logger.error("could not update {} on {}: push rejected".format(name, urls[url]))
+        return ok
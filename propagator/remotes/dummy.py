@@ -51,7 +51,7 @@ class Remote(RemoteBase):
     def rename(self, name, dest):
         print("rename repo - {}, {}".format(name, dest))
 
-    def update(self, repo, name):
+    def update(self, repo, name, refs = None):
         print("update repo - {}".format(name))
 
     def delete(self, name):
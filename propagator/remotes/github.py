@@ -30,7 +30,9 @@
 import re
 import os
 import sys
+import time
 import requests
+import threading
 
 try:
     import simplejson as json
@@ -39,7 +41,48 @@ except ImportError:
 
 from propagator.core.sync import restricted_sync
 from propagator.core.config import config_general
-from propagator.remotes.remotebase import RemoteBase
+from propagator.core.tracing import span
+from propagator.remotes.remotebase import RemoteBase, AuthError
+from propagator.remotes.ratelimit import RateLimiter, RateLimitedSession, RateLimited
+
+class RepoCache(object):
+    # remembers which repositories exist on github, along with their metadata
+    # and etag, so that most existence checks never hit the api, and the rest
+    # are conditional requests that do not count against the rate limit
+
+    def __init__(self, ttl, negative_ttl):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name.lower())
+
+    def set(self, name, exists, meta = None, etag = None):
+        ttl = self.ttl if exists else self.negative_ttl
+        entry = { "exists": exists, "meta": meta, "etag": etag, "expires": time.monotonic() + ttl }
+        with self.lock:
+            self.entries[name.lower()] = entry
+
+    def refresh(self, name):
+        with self.lock:
+            entry = self.entries.get(name.lower())
+            if entry:
+                entry["expires"] = time.monotonic() + (self.ttl if entry["exists"] else self.negative_ttl)
+
+    def drop(self, name):
+        with self.lock:
+            self.entries.pop(name.lower(), None)
+
+    def evict(self):
+        now = time.monotonic()
+        with self.lock:
+            for name in [k for k, v in self.entries.items() if v["expires"] < now]:
+                del self.entries[name]
+
+is_fresh = lambda entry: (entry is not None) and (entry["expires"] >= time.monotonic())
 
 class Remote(RemoteBase):
     ENDPOINT_REPO = "https://api.github.com/repos"
@@ -57,11 +100,46 @@ class Remote(RemoteBase):
         self.access_token = cfgdict["access_token"]
         self.organization = cfgdict["organization"]
         self.except_checks = tuple(re.compile(i) for i in cfgdict["excepts"])
+        self.routing = tuple(cfgdict.get("routing", ("#",)))
         self.repo_base = config_general.get("repobase")
 
-        self.session = requests.Session()
+        # every api call goes through a rate limiter shared by all workers
+        limiter = RateLimiter(int(cfgdict.get("ratelimit_reserve", 500)), int(cfgdict.get("ratelimit_max_wait", 60)))
+        self.session = RateLimitedSession(limiter)
         self.session.headers.update({"Accept": "application/vnd.github.v3+json"})
         self.session.headers.update({"Authorization": " ".join(("token", self.access_token))})
+        self.session.hooks["response"].append(self._check_auth)
+
+        # set up the existence cache, and fill it from the organisation's
+        # repository listing so that we start off knowing about every repo
+        self.cache = RepoCache(int(cfgdict.get("cache_ttl", 3600)), int(cfgdict.get("cache_negative_ttl", 60)))
+        if cfgdict.get("cache_warm", True):
+            self._warm_cache()
+
+    def _warm_cache(self):
+        url = "{0}/{1}/{2}".format(self.ENDPOINT_ORGS, self.organization, "repos")
+        params = { "per_page": 100 }
+        count = 0
+        try:
+            while url:
+                r = self.session.get(url, params = params)
+                if not r.ok:
+                    self.logger.warning("could not list repositories for cache warm-up: {}".format(r.status_code))
+                    return
+                for meta in r.json():
+                    self.cache.set(meta["name"], True, meta)
+                    count = count + 1
+                url = r.links.get("next", {}).get("url")
+                params = None
+        except (requests.RequestException, RateLimited, AuthError):
+            self.logger.exception()
+            return
+        self.logger.info("warmed repository cache with {} repositories".format(count))
+
+    def _check_auth(self, r, *args, **kwargs):
+        # a bad token fails every call, so tell the slave not to keep retrying
+        if r.status_code == 401:
+            raise AuthError("github rejected the access token")
 
     def _strip_reponame(self, name):
         if name.endswith(".git"):
@@ -69,9 +147,26 @@ class Remote(RemoteBase):
         return name
 
     def _repo_exists(self, name):
+        name = self._strip_reponame(name)
+        entry = self.cache.get(name)
+        if is_fresh(entry):
+            return entry["exists"]
+        self.cache.evict()
+
+        # revalidate a stale entry with a conditional request
+        headers = {}
+        if entry and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
         url = "{0}/{1}/{2}".format(self.ENDPOINT_REPO, self.organization, name)
-        r = self.session.get(url)
-        return ((r.ok) and ("id" in r.json().keys()))
+        r = self.session.get(url, headers = headers)
+        if (r.status_code == 304) and entry:
+            self.cache.refresh(name)
+            return entry["exists"]
+
+        exists = ((r.ok) and ("id" in r.json().keys()))
+        if exists or (r.status_code == 404):
+            self.cache.set(name, exists, r.json() if exists else None, r.headers.get("ETag"))
+        return exists
 
     def can_handle_repo(self, name):
         name = self._strip_reponame(name)
@@ -97,7 +192,10 @@ class Remote(RemoteBase):
         }
         url = "{0}/{1}/{2}".format(self.ENDPOINT_ORGS, self.organization, "repos")
         r = self.session.post(url, data = json.dumps(payload))
-        return ((r.status_code == 201) and ("id" in r.json().keys()))
+        created = ((r.status_code == 201) and ("id" in r.json().keys()))
+        if created:
+            self.cache.set(name, True, r.json(), r.headers.get("ETag"))
+        return created
 
     def rename(self, name, dest):
         name = self._strip_reponame(name)
@@ -105,19 +203,35 @@ class Remote(RemoteBase):
         payload = { "name": dest }
         url = "{0}/{1}/{2}".format(self.ENDPOINT_REPO, self.organization, name)
         r = self.session.patch(url, data = json.dumps(payload))
+        if r.ok:
+            self.cache.drop(name)
+            self.cache.set(dest, True, r.json(), r.headers.get("ETag"))
         return ((r.status_code == 201) and ("id" in r.json().keys()))
 
-    def update(self, repo, name):
+    def routing_patterns(self):
+        # the except rules are arbitrary regexes the broker cannot evaluate,
+        # so the coarse broker-side filter is configured next to them
+        return self.routing
+
+    def remote_url(self, name):
+        return "git@github.com:{0}/{1}".format(self.organization, name)
+
+    def update(self, repo, name, refs = None):
         srcdir = os.path.join(self.repo_base, name)
-        desturl = "git@github.com:{0}/{1}".format(self.organization, name)
-        if not self._repo_exists(name):
-            self.create(name, repo.description)
-        return restricted_sync(srcdir, desturl)
+        desturl = self.remote_url(name)
+        with span("github.repo_exists"):
+            exists = self._repo_exists(name)
+        if not exists:
+            with span("github.create"):
+                self.create(name, repo.description)
+        return restricted_sync(srcdir, desturl, refs)
 
     def delete(self, name):
         name = self._strip_reponame(name)
         url = "{0}/{1}/{2}".format(self.ENDPOINT_REPO, self.organization, name)
         r = self.session.delete(url)
+        if r.status_code in (204, 404):
+            self.cache.set(name, False)
         return (r.status_code == 204)
 
     def setdesc(self, name, desc):
@@ -125,4 +239,6 @@ class Remote(RemoteBase):
         payload = { "name": name, "description": desc }
         url = "{0}/{1}/{2}".format(self.ENDPOINT_REPO, self.organization, name)
         r = self.session.patch(url, data = json.dumps(payload))
+        if r.ok:
+            self.cache.set(name, True, r.json(), r.headers.get("ETag"))
         return ((r.status_code == 201) and ("id" in r.json().keys()))
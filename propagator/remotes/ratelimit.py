@@ -0,0 +1,125 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+#   Copyright (C) 2015-2016 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import time
+import threading
+import requests
+
+from propagator.core.tracing import span
+from propagator.remotes.remotebase import DeferTask
+
+class RateLimited(DeferTask):
+    pass
+
+class RateLimiter(object):
+    # schedules api calls from every thread in the slave against the quota
+    # github reports back. while there is plenty of quota left, calls go out
+    # as fast as they come. once the remaining calls drop below the reserve,
+    # they are spread evenly over the time left until the quota resets. when
+    # the quota is gone, or github asks us to back off, nothing goes out until
+    # the reset time.
+
+    def __init__(self, reserve = 500, max_wait = 60):
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.remaining = None
+        self.reset = 0
+        self.blocked_until = 0
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def _interval(self, now):
+        if (self.remaining is None) or (self.remaining > self.reserve):
+            return 0
+        window = max(0, self.reset - now)
+        return window / max(1, self.remaining)
+
+    def acquire(self):
+        # reserve the next free slot and return how long to wait for it
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot, self.blocked_until)
+            wait = slot - now
+            if wait > self.max_wait:
+                raise RateLimited(wait, "github rate limit, retry in {:.0f} seconds".format(wait))
+            self.next_slot = slot + self._interval(slot)
+            if self.remaining is not None:
+                self.remaining = max(0, self.remaining - 1)
+        return wait
+
+    def update(self, r):
+        # read the quota headers, and notice primary and secondary limits
+        now = time.time()
+        with self.lock:
+            try:
+                self.remaining = int(r.headers["X-RateLimit-Remaining"])
+                self.reset = int(r.headers["X-RateLimit-Reset"])
+            except (KeyError, ValueError):
+                pass
+
+            if not is_rate_limited(r):
+                return False
+            retry_after = r.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                until = now + int(retry_after)
+            elif self.remaining == 0:
+                until = self.reset
+            else:
+                # secondary limit without a hint, github asks for a minute
+                until = now + 60
+            self.blocked_until = max(self.blocked_until, until)
+            return True
+
+def is_rate_limited(r):
+    if r.status_code == 429:
+        return True
+    if r.status_code != 403:
+        return False
+    if r.headers.get("X-RateLimit-Remaining") == "0" or ("Retry-After" in r.headers):
+        return True
+    return "rate limit" in r.text.lower()
+
+class RateLimitedSession(requests.Session):
+    def __init__(self, limiter):
+        super().__init__()
+        self.limiter = limiter
+
+    def request(self, method, url, *args, **kwargs):
+        # a call that hits the limit is retried once after waiting it out. if
+        # the wait is too long, the limiter raises RateLimited instead.
+        for attempt in range(2):
+            wait = self.limiter.acquire()
+            if wait > 0:
+                with span("github.ratelimit_wait"):
+                    time.sleep(wait)
+            with span("github.api.{}".format(method.lower())):
+                r = super().request(method, url, *args, **kwargs)
+            if not self.limiter.update(r):
+                break
+        return r
@@ -30,6 +30,23 @@
 import abc
 from logbook import Logger
 
+class DeferTask(Exception):
+    # raised by a plugin when an operation cannot be done right now, but
+    # should be tried again after the given delay (in seconds). the slave
+    # does not count a deferral as a failed attempt.
+    def __init__(self, delay, reason = None):
+        super().__init__(reason or "task deferred for {} seconds".format(delay))
+        self.delay = delay
+
+class AuthError(Exception):
+    # raised by a plugin when the remote rejected our credentials
+    pass
+
+class PermanentError(Exception):
+    # raised by a plugin when an operation can never succeed as asked, so
+    # retrying it is pointless
+    pass
+
 class RemoteBase(abc.ABC):
     def __init__(self, opslog):
         self.logger = opslog
@@ -56,7 +73,9 @@ class RemoteBase(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def update(self, repo, name):
+    def update(self, repo, name, refs = None):
+        # refs, if given, lists the ref changes ({ "old", "new", "ref" }) that
+        # are all the mirror is missing, so only those need to be pushed
         pass
 
     @abc.abstractmethod
@@ -66,3 +85,24 @@ class RemoteBase(abc.ABC):
     @abc.abstractmethod
     def setdesc(self, name, desc):
         pass
+
+    def routing_patterns(self):
+        # topic patterns (after the target word, see amqp.routing_keys) for
+        # the repositories this remote wants the broker to deliver. anything
+        # delivered is still checked with can_handle_repo.
+        return ("#",)
+
+    def remote_url(self, name):
+        # the git url a repository is mirrored to, if the remote has one
+        return None
+
+    def remote_urls(self, name):
+        # every git url a repository is mirrored to, for remotes that keep
+        # more than one copy of it
+        url = self.remote_url(name)
+        return [url] if url else []
+
+    def git_env(self):
+        # extra environment for git talking to the remote's urls, like the
+        # GIT_SSH_COMMAND it needs to authenticate
+        return {}
@@ -27,25 +27,48 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
 # THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import re
 import pika
 from propagator.core.config import config_amqp
 
 queue_name_for_slave = lambda slave_name: "propagator.slave.{}".format(slave_name)
 delay_queue_name_for_slave = lambda slave_name: "propagator.slave.{}.delay".format(slave_name)
-exchange_name = lambda: "propagator.exchange.master"
+delay_level_queue_name = lambda slave_name, level: "propagator.slave.{}.delay.{}".format(slave_name, level)
+exchange_name = lambda: "propagator.exchange.routed"
 delay_exchange_name = lambda: "propagator.exchange.delay"
 
-def create_channel():
+# messages are routed by the broker with a topic exchange. a routing key looks
+# like "<target>.<scope>.<namespace>", where the target is the remote the
+# message is meant for (or "any"), the scope is "top" for top-level
+# repositories and "ns" for namespaced ones, and the namespace is the first
+# path component of a namespaced repository (or "_").
+routing_word = lambda word: re.sub(r"[^A-Za-z0-9_-]", "_", word) or "_"
+ANY_TARGET = "any"
+
+def routing_keys(payload):
+    name = payload.get("repository") or ""
+    head, sep, tail = name.partition("/")
+    if sep:
+        scope = "ns.{}".format(routing_word(head))
+    else:
+        scope = "top._"
+    targets = payload.get("remote_for") or (ANY_TARGET,)
+    return ["{}.{}".format(routing_word(i), scope) for i in targets]
+
+def create_channel(timeout = None):
     # get the relevant configuration and set sane defaults
     amqp_user = config_amqp.get("user", "guest")
     amqp_pass = config_amqp.get("pass", "guest")
     amqp_host = config_amqp.get("host", "localhost")
     amqp_port = config_amqp.get("port", 5672)
     amqp_vhost = config_amqp.get("vhost", "/")
+    amqp_timeout = float(timeout or config_amqp.get("connect_timeout", 5))
 
-    # connect to the amqp server
+    # connect to the amqp server. the timeouts bound how long an unreachable
+    # broker can hold us up, for the socket connect and the whole handshake.
     creds = pika.PlainCredentials(amqp_user, amqp_pass)
-    params = pika.ConnectionParameters(amqp_host, amqp_port, amqp_vhost, creds)
+    params = pika.ConnectionParameters(amqp_host, amqp_port, amqp_vhost, creds,
+        socket_timeout = amqp_timeout, stack_timeout = amqp_timeout)
     conn = pika.BlockingConnection(params)
     channel = conn.channel()
 
@@ -54,34 +77,49 @@ def create_channel():
 
 def prepare_channel_producer(channel):
     # just declare the exchange and return the channel
-    channel.exchange_declare(exchange = exchange_name(), exchange_type = "fanout", auto_delete = True)
+    channel.exchange_declare(exchange = exchange_name(), exchange_type = "topic", auto_delete = True)
     return channel
 
-def prepare_channel_consumer(channel, slave_name):
+def prepare_channel_consumer(channel, slave_name, patterns = ("#",), delay_levels = ()):
     # we need the exchange declared too...
     channel = prepare_channel_producer(channel)
 
-    # declare the message exchange and a queue for the slave, and bind them
+    # declare the message exchange and a queue for the slave, and bind them.
+    # the slave gets messages for itself and for any remote, restricted to
+    # the repository patterns its remote plugin asked for.
     queue_name = queue_name_for_slave(slave_name)
     channel.queue_declare(queue = queue_name, auto_delete = True)
-    channel.queue_bind(queue = queue_name, exchange = exchange_name())
+    for target in (routing_word(slave_name), ANY_TARGET):
+        for pattern in patterns:
+            binding = "{}.{}".format(target, pattern)
+            channel.queue_bind(queue = queue_name, exchange = exchange_name(), routing_key = binding)
 
     # ...and the dead-letter exchange
-    delay_queue_name = delay_queue_name_for_slave(slave_name)
     channel.exchange_declare(exchange = delay_exchange_name(), exchange_type = "direct", auto_delete = True)
-    channel.queue_declare(queue = delay_queue_name, durable = True, arguments = {
-        "x-dead-letter-exchange": delay_exchange_name(),
-        "x-dead-letter-routing-key": queue_name
-    })
     channel.queue_bind(queue = queue_name, exchange = delay_exchange_name(), routing_key = queue_name)
 
+    # retries wait in one delay queue per backoff level (in milliseconds),
+    # and are dead-lettered back into the slave's queue when they expire.
+    # the old single delay queue is still declared so that retries parked
+    # there by an older slave find their way back.
+    delay_queues = [(delay_queue_name_for_slave(slave_name), None)]
+    delay_queues.extend((delay_level_queue_name(slave_name, i), i) for i in delay_levels)
+    for delay_queue_name, level in delay_queues:
+        arguments = {
+            "x-dead-letter-exchange": delay_exchange_name(),
+            "x-dead-letter-routing-key": queue_name
+        }
+        if level:
+            arguments["x-message-ttl"] = level
+        channel.queue_declare(queue = delay_queue_name, durable = True, arguments = arguments)
+
     # done, return channel
     return channel
 
-def create_channel_producer():
-    channel = create_channel()
+def create_channel_producer(timeout = None):
+    channel = create_channel(timeout)
     return prepare_channel_producer(channel)
 
-def create_channel_consumer(slave_name):
+def create_channel_consumer(slave_name, patterns = ("#",), delay_levels = ()):
     channel = create_channel()
-    return prepare_channel_consumer(channel, slave_name)
+    return prepare_channel_consumer(channel, slave_name, patterns, delay_levels)
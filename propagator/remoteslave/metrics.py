@@ -0,0 +1,181 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2015 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# A small, dependency-free metrics registry for the slave, exposed over HTTP
+# in the Prometheus text exposition format.
+
+import math
+import threading
+import http.server
+
+from logbook import Logger
+log = Logger("Metrics")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def format_labels(names, values, extra = ()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+    return "{" + ",".join("{}=\"{}\"".format(k, escape(v)) for k, v in pairs) + "}"
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name, doc, labels = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(i, "")) for i in self.labels)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.doc), "# TYPE {} {}".format(self.name, self.kind)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key, value):
+        return ["{}{} {}".format(self.name, format_labels(self.labels, key), format_value(value))]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount = 1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels = (), buckets = DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = { "counts": [0] * len(self.buckets), "sum": 0.0, "count": 0 }
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["counts"][i] = entry["counts"][i] + 1
+            entry["sum"] = entry["sum"] + value
+            entry["count"] = entry["count"] + 1
+
+    def render_value(self, key, value):
+        lines = []
+        for bound, count in zip(self.buckets, value["counts"]):
+            labels = format_labels(self.labels, key, (("le", format_value(bound)),))
+            lines.append("{}_bucket{} {}".format(self.name, labels, count))
+        labels = format_labels(self.labels, key)
+        lines.append("{}_sum{} {}".format(self.name, labels, format_value(value["sum"])))
+        lines.append("{}_count{} {}".format(self.name, labels, value["count"]))
+        return lines
+
+class Registry(object):
+    def __init__(self, prefix = ""):
+        self.prefix = prefix
+        self.metrics = []
+
+    def add(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics.append(metric)
+        return metric
+
+    counter = lambda self, *args, **kwargs: self.add(Counter(*args, **kwargs))
+    gauge = lambda self, *args, **kwargs: self.add(Gauge(*args, **kwargs))
+    histogram = lambda self, *args, **kwargs: self.add(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        for callback in self.server.before_render:
+            callback()
+        data = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def serve(registry, address, port, tries = 16, before_render = ()):
+    # several slave processes may share a configuration, so take the first
+    # free port starting at the configured one
+    for candidate in range(port, port + tries):
+        try:
+            server = http.server.ThreadingHTTPServer((address, candidate), MetricsHandler)
+        except OSError:
+            continue
+        server.daemon_threads = True
+        server.registry = registry
+        server.before_render = tuple(before_render)
+        thread = threading.Thread(target = server.serve_forever, daemon = True)
+        thread.start()
+        return server
+    log.warning("no free port for the metrics endpoint in {}-{}".format(port, port + tries - 1))
+    return None
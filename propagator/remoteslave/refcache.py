@@ -0,0 +1,125 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2015 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import time
+import hashlib
+import tempfile
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from propagator.core.config import config_general
+from propagator.core.refs import refs_digest
+
+class RefCache(object):
+    def __init__(self, slave_name):
+        cachedir = config_general.get("cache_dir", "~/.propagator/cache")
+        self.cachedir = os.path.join(os.path.expanduser(cachedir), "refs", slave_name)
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir, exist_ok = True)
+
+    def _path(self, name):
+        # hash the name so that nested repository paths map to a flat directory
+        digest = hashlib.sha1(name.encode("utf-8")).hexdigest()
+        return os.path.join(self.cachedir, "{}.json".format(digest))
+
+    def _load(self, name):
+        try:
+            with open(self._path(name)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get("repository") != name:
+            return {}
+        return data
+
+    def get(self, name):
+        return self._load(name).get("refs")
+
+    def synced_at(self, name):
+        return self._load(name).get("synced_at", 0)
+
+    def set(self, name, refs, synced_at = None):
+        # write to a temporary file first and move it in place, so that other
+        # slave processes never see a half-written entry
+        data = {
+            "repository": name,
+            "refs": refs,
+            "digest": refs_digest(refs),
+            "synced_at": synced_at or time.time()
+        }
+        fd, tmppath = tempfile.mkstemp(dir = self.cachedir, suffix = ".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmppath, self._path(name))
+        except OSError:
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+
+    def invalidate(self, name):
+        try:
+            os.unlink(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def is_current(self, name, digest):
+        return (digest is not None) and (self._load(name).get("digest") == digest)
+
+    def covers(self, name, refs, changes):
+        # true if the last synced state plus the given ref changes is exactly
+        # the current state, i.e. pushing just those refs brings a mirror that
+        # was in sync fully up to date
+        cached = self.get(name)
+        if cached is None:
+            return False
+        for change in changes:
+            ref = change["ref"]
+            if ref in refs:
+                cached[ref] = refs[ref]
+            else:
+                cached.pop(ref, None)
+        return cached == refs
+
+def merge_changes(first, second):
+    # merge two lists of ref changes into one going from the oldest old value
+    # to the newest new value of each ref. if either side didn't say which
+    # refs changed, neither does the result.
+    if (first is None) or (second is None):
+        return None
+    merged = {}
+    for change in first + second:
+        entry = merged.setdefault(change["ref"], dict(change))
+        entry["new"] = change["new"]
+    return [i for i in merged.values() if i["old"] != i["new"]]
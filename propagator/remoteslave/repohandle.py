@@ -0,0 +1,139 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2015 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import git
+import threading
+import collections
+
+from propagator.core.catalog import git_dir_for, read_description
+from propagator.core.refs import read_refs
+
+class RepoHandle(object):
+    # a cheap stand-in for git.Repo. everything the slave and the remote
+    # plugins usually need is answered from the catalog or by reading the
+    # repository files, and a full git.Repo is only built when asked for.
+    # the catalog is looked up once per message, by RepoHandleCache.get(),
+    # and every answer for that message comes from the same row. that lookup
+    # still lists the loose ref directories to check that the row is
+    # current, see refs_stamp() for what that costs.
+
+    def __init__(self, path, catalog):
+        self.path = path
+        self.catalog = catalog
+        self._info = None
+        self._repo = None
+        self._lock = threading.Lock()
+
+    def info(self):
+        return self._info
+
+    def refresh(self, info = None):
+        self._info = self.catalog.lookup(self.path) if info is None else info
+        return self._info
+
+    @property
+    def exists(self):
+        return self._info is not None
+
+    @property
+    def gitdir(self):
+        return self._info["gitdir"] if self._info else git_dir_for(self.path)[0]
+
+    @property
+    def description(self):
+        return read_description(self.gitdir)
+
+    @property
+    def has_branches(self):
+        return bool(self._info and self._info["has_heads"])
+
+    @property
+    def ref_digest(self):
+        return self._info["ref_digest"] if self._info else None
+
+    def refs(self):
+        return read_refs(self.gitdir)
+
+    @property
+    def git_repo(self):
+        with self._lock:
+            if self._repo is None:
+                self._repo = git.Repo(self.path)
+            return self._repo
+
+    def close(self):
+        # stop any persistent cat-file helpers the git.Repo may have started
+        with self._lock:
+            if self._repo is not None:
+                self._repo.close()
+                self._repo = None
+
+class RepoHandleCache(object):
+    def __init__(self, catalog, maxsize = 128):
+        self.catalog = catalog
+        self.maxsize = maxsize
+        self.handles = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        # returns a handle for the repository at path, or None if there is
+        # no repository there. the handle carries the catalog row looked up
+        # here until the next get().
+        info = self.catalog.lookup(path)
+        if not info:
+            self.discard(path)
+            return None
+
+        evicted = []
+        with self.lock:
+            handle = self.handles.get(path)
+            if handle:
+                self.handles.move_to_end(path)
+            else:
+                handle = RepoHandle(path, self.catalog)
+                self.handles[path] = handle
+                while len(self.handles) > self.maxsize:
+                    evicted.append(self.handles.popitem(last = False)[1])
+        handle.refresh(info)
+        for i in evicted:
+            i.close()
+        return handle
+
+    def discard(self, path):
+        with self.lock:
+            handle = self.handles.pop(path, None)
+        if handle:
+            handle.close()
+
+    def clear(self):
+        with self.lock:
+            handles = list(self.handles.values())
+            self.handles.clear()
+        for i in handles:
+            i.close()
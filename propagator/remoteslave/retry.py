@@ -0,0 +1,144 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2016 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import re
+import random
+import socket
+
+import git
+import requests
+
+from propagator.remotes.remotebase import DeferTask, AuthError, PermanentError
+
+# failure classes. a transient failure (network trouble, a remote having a bad
+# moment) is retried with exponential backoff. a rate limit is waited out
+# without counting against the retry limit. an authentication failure needs
+# a human to fix the credentials, so it is only retried a couple of times at
+# the longest interval. a permanent failure is never retried.
+TRANSIENT = "transient"
+RATELIMIT = "ratelimit"
+AUTH = "auth"
+PERMANENT = "permanent"
+
+GIT_AUTH_ERRORS = re.compile("|".join((
+    r"permission denied",
+    r"authentication failed",
+    r"could not read username",
+    r"host key verification failed",
+    r"invalid username or password",
+)), re.I)
+
+GIT_PERMANENT_ERRORS = re.compile("|".join((
+    r"does not appear to be a git repository",
+    r"not a git repository",
+    r"hook declined",
+    r"protected branch",
+    r"pushing to this branch is not allowed",
+)), re.I)
+
+def classify_http(status):
+    if status in (401, 403):
+        return AUTH
+    if status == 429:
+        return RATELIMIT
+    if status in (400, 404, 410, 422):
+        return PERMANENT
+    return TRANSIENT
+
+def classify(exc):
+    # work out which failure class an exception raised by an operation falls
+    # into. anything we don't recognise is assumed to be transient, which is
+    # what every failure used to be treated as.
+    if isinstance(exc, DeferTask):
+        return RATELIMIT
+    if isinstance(exc, AuthError):
+        return AUTH
+    if isinstance(exc, PermanentError):
+        return PERMANENT
+    if isinstance(exc, requests.HTTPError) and (exc.response is not None):
+        return classify_http(exc.response.status_code)
+    if isinstance(exc, git.GitCommandError):
+        stderr = str(exc.stderr or "")
+        if GIT_AUTH_ERRORS.search(stderr):
+            return AUTH
+        if GIT_PERMANENT_ERRORS.search(stderr):
+            return PERMANENT
+        return TRANSIENT
+    if isinstance(exc, (requests.RequestException, socket.error)):
+        return TRANSIENT
+    return TRANSIENT
+
+class RetryPolicy(object):
+    # retries are parked in one delay queue per backoff level, each with its
+    # own queue ttl. the broker only expires the message at the head of a
+    # queue, so a single queue with per-message ttls holds a short retry
+    # back until every longer one queued before it has expired. with levels
+    # a power of two apart, a message only ever waits behind others from the
+    # same level, and a delay longer than the first level is never late by
+    # more than half its level. anything shorter, like a short DeferTask
+    # wait, still waits out the whole first level (retry_interval_step).
+
+    def __init__(self, base, cap, max_retries, auth_retries = 2):
+        self.base = max(1, base)
+        self.cap = max(self.base, cap)
+        self.max_retries = max_retries
+        self.auth_retries = auth_retries
+
+        levels = []
+        level = self.base
+        while level < self.cap:
+            levels.append(level)
+            level = level * 2
+        levels.append(self.cap)
+        self.levels = tuple(levels)
+
+    def level_for(self, delay):
+        # the shortest level the delay fits in, in milliseconds
+        for level in self.levels:
+            if delay <= level:
+                return level
+        return self.levels[-1]
+
+    def backoff(self, attempt):
+        # capped exponential backoff with equal jitter: at least half the
+        # nominal delay, so retries are not hammered, plus a random part so
+        # that a burst of failures doesn't come back all at once
+        delay = min(self.cap, self.base * (2 ** max(0, attempt - 1)))
+        return int(delay / 2 + random.uniform(0, delay / 2))
+
+    def delay_for(self, error, attempt):
+        # return how long to wait before the given attempt, or None if the
+        # task should not be retried at all
+        if error == PERMANENT:
+            return None
+        if error == AUTH:
+            return self.cap if attempt <= self.auth_retries else None
+        if attempt > self.max_retries:
+            return None
+        return self.backoff(attempt)
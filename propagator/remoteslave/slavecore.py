@@ -29,11 +29,15 @@
 
 import sys
 import os
-import git
 import pika
 import signal
 import logbook
 import importlib
+import time
+import threading
+import functools
+import collections
+import concurrent.futures
 
 try:
     import simplejson as json
@@ -41,8 +45,17 @@ except ImportError:
     import json
 
 from propagator import VERSION as version
-from propagator.core.config import config_general
+from propagator.core.config import config_general, config_metrics
+from propagator.core import sync
+from propagator.core import tracing
+from propagator.core.catalog import catalog
+from propagator.core.transport import transport
 from propagator.remoteslave import amqp
+from propagator.remoteslave import metrics
+from propagator.remoteslave import retry
+from propagator.remoteslave.refcache import RefCache, merge_changes
+from propagator.remoteslave.repohandle import RepoHandleCache
+from propagator.remotes.remotebase import DeferTask
 
 class SlaveCore(object):
     def __init__(self, slave_name):
@@ -53,26 +66,70 @@ class SlaveCore(object):
 
         # create the operations log handler and load in the slave, and other things
         self.opslog = self.init_slave_logger(slave_name)
+        self.tracelog = self.init_trace_logger(slave_name)
         self.remote = self.init_slave_module(slave_name).Remote(self.opslog)
         self.repobase = config_general.get("repobase")
-        self.max_retries = int(config_general.get("max_retries", 5))
-        self.retry_step = int(config_general.get("retry_interval_step", 300)) * 1000
+        self.retry = retry.RetryPolicy(
+            int(config_general.get("retry_interval_step", 300)) * 1000,
+            int(config_general.get("retry_max_interval", 3600)) * 1000,
+            int(config_general.get("max_retries", 5)),
+            int(config_general.get("retry_auth_attempts", 2))
+        )
         self.slave_name = slave_name
+        self.refcache = RefCache(slave_name)
+        self.handles = RepoHandleCache(catalog(), int(config_general.get("repo_handle_cache", 128)))
 
-        # set up the amqp channel, and bind it to the consumer callback
-        self.channel = amqp.create_channel_consumer(slave_name)
+        # set up the worker pool. tasks for the same repository are queued
+        # behind each other, and run one at a time in the order they came in.
+        self.workers = max(1, int(config_general.get("workers", 1)))
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = self.workers)
+        self.repo_queues = {}
+        self.repo_queues_guard = threading.Lock()
+
+        # update messages are held back for a short window so that bursts of
+        # updates to the same repository are merged into a single push
+        self.coalesce_window = float(config_general.get("coalesce_window", 0))
+        self.coalesce_max_pending = int(config_general.get("coalesce_max_pending", 64))
+        self.pending = {}
+
+        # set up the amqp channel, and bind it to the consumer callback. the
+        # broker never hands us more unacked messages than we have workers,
+        # plus however many updates we may be holding back.
+        prefetch = self.workers
+        if self.coalesce_window > 0:
+            prefetch = prefetch + self.coalesce_max_pending
+        self.channel = amqp.create_channel_consumer(slave_name, self.remote.routing_patterns(), self.retry.levels)
+        self.channel.basic_qos(prefetch_count = prefetch)
         self.channel.basic_consume(self.process_single_message, amqp.queue_name_for_slave(slave_name))
 
+        # start the metrics endpoint
+        self.init_metrics()
+
     def __call__(self):
         # set up sigterm to also raise KeyboardInterrupt
         signal.signal(signal.SIGTERM, signal.getsignal(signal.SIGINT))
-        self.log.info("listening for new tasks...")
+        self.log.info("listening for new tasks with {} workers...".format(self.workers))
+        self.poll_queue_depth()
+        self.maintain_transport()
         try:
             self.channel.start_consuming()
         except KeyboardInterrupt:
             self.channel.stop_consuming()
         self.log.info("slave is shutting down...")
 
+        # held back updates are never acked, so the broker redelivers them
+        for entry in self.pending.values():
+            entry["timer"].cancel()
+        self.pending.clear()
+
+        # let running tasks finish, then flush their acks to the broker.
+        # anything left unacked is redelivered to another slave.
+        self.pool.shutdown(wait = True)
+        self.channel.connection.process_data_events(time_limit = 0)
+        self.handles.clear()
+        if transport():
+            transport().close()
+
     def init_slave_logger(self, slave_name):
         # get the logs directory and ensure that it exists
         logdir = config_general.get("logs_dir", "~/.propagator/logs")
@@ -88,6 +145,89 @@ class SlaveCore(object):
         # done, return logger
         return logger
 
+    def init_trace_logger(self, slave_name):
+        # every processed message is written to this log as a json line with
+        # its trace id and the timed spans of each stage
+        logdir = os.path.expanduser(config_general.get("logs_dir", "~/.propagator/logs"))
+        logpath = os.path.join(logdir, "remote.{}.trace.jsonl".format(slave_name))
+        logger = logbook.Logger("trace-{}".format(slave_name))
+        logger.handlers.append(logbook.FileHandler(logpath, format_string = "{record.message}", bubble = False))
+        return logger
+
+    def write_trace(self, trace, data):
+        record = trace.record(
+            slave = self.slave_name,
+            pid = os.getpid(),
+            operation = data.get("operation"),
+            repository = data.get("repository"),
+            attempt = data.get("attempt"),
+            error_class = data.get("error_class")
+        )
+        self.tracelog.info(json.dumps(record))
+
+    def count_outcome(self, op, result):
+        self.m_operations.inc(operation = op, result = result)
+        trace = tracing.current()
+        if trace:
+            trace.outcome = result
+
+    def init_metrics(self):
+        registry = metrics.Registry("propagator_slave_")
+        self.m_operations = registry.counter("operations_total", "Operations processed, by operation and result", ("operation", "result"))
+        self.m_duration = registry.histogram("operation_duration_seconds", "Time spent processing an operation", ("operation",))
+        self.m_pushes = registry.counter("pushes_total", "Git pushes, by result", ("result",))
+        self.m_push_duration = registry.histogram("push_duration_seconds", "Time spent in git push")
+        self.m_push_bytes = registry.counter("push_bytes_total", "Pack data sent by git push")
+        self.m_retries = registry.counter("retries_total", "Retries scheduled, by attempt number", ("attempt",))
+        self.m_errors = registry.counter("errors_total", "Failed operations, by failure class", ("operation", "class"))
+        self.m_deferrals = registry.counter("deferrals_total", "Operations deferred at the request of the remote", ("operation",))
+        self.m_failures = registry.counter("permanent_failures_total", "Operations given up after the last retry", ("operation",))
+        self.m_in_flight = registry.gauge("tasks_in_flight", "Tasks currently running on the worker pool")
+        self.m_pending = registry.gauge("updates_pending", "Updates held back for coalescing")
+        self.m_queue_depth = registry.gauge("queue_depth", "Messages waiting in the slave's queue")
+        self.m_queue_latency = registry.histogram("queue_latency_seconds", "Time from a message being queued to it being picked up")
+        sync.add_push_observer(self.observe_push)
+
+        # port 0 turns the endpoint off
+        port = int(config_metrics.get("port", 9150))
+        self.metrics_server = None
+        if port:
+            address = config_metrics.get("address", "127.0.0.1")
+            self.metrics_server = metrics.serve(registry, address, port, before_render = (self.update_gauges,))
+            if self.metrics_server:
+                self.log.info("serving metrics on {}:{}".format(*self.metrics_server.server_address))
+
+    def observe_push(self, stats):
+        self.m_pushes.inc(result = "success" if stats["ok"] else "failure")
+        self.m_push_duration.observe(stats["duration"])
+        self.m_push_bytes.inc(stats["bytes"])
+
+    def update_gauges(self):
+        self.m_pending.set(len(self.pending))
+
+    def poll_queue_depth(self):
+        # the channel belongs to the connection thread, so the poll is done
+        # there and rescheduled from a timer
+        try:
+            frame = self.channel.queue_declare(queue = amqp.queue_name_for_slave(self.slave_name), passive = True)
+            self.m_queue_depth.set(frame.method.message_count)
+        except (pika.exceptions.AMQPError, AttributeError):
+            pass
+        timer = threading.Timer(int(config_metrics.get("queue_poll_interval", 15)), self.threadsafe, (self.poll_queue_depth,))
+        timer.daemon = True
+        timer.start()
+
+    def maintain_transport(self):
+        # health checks and idle eviction for the pooled ssh connections.
+        # this never touches the channel, so it runs on its own timer thread.
+        ssh = transport()
+        if not ssh:
+            return
+        ssh.maintain()
+        timer = threading.Timer(int(config_general.get("ssh_check_interval", 60)), self.maintain_transport)
+        timer.daemon = True
+        timer.start()
+
     def init_slave_module(self, slave_name):
         self.log.info("remote plugin requested: {}".format(slave_name))
         plugin_name = "propagator.remotes.{}".format(slave_name)
@@ -101,14 +241,107 @@ class SlaveCore(object):
         return remote
 
     def process_single_message(self, channel, method, properties, body):
+        # validate the message on the connection thread, and only hand real
+        # work to the worker pool. the message is acked once its task is done.
+        received = time.monotonic()
+        data = self.parse_message(body)
+        if data is None:
+            channel.basic_ack(method.delivery_tag)
+            return
+
+        # producers stamp a trace id on each message, and retries keep it
+        trace = tracing.Trace(data.get("trace_id"), received)
+        trace.add("decode", received, time.monotonic())
+        data["trace_id"] = trace.trace_id
+
+        if (self.coalesce_window > 0) and (data["operation"] == "update"):
+            self.coalesce_update(method.delivery_tag, data, trace)
+            return
+
+        # updates held back for this repository came first, so they have to
+        # be queued before anything else for it, like a rename or a delete
+        for key in [i for i in self.pending if i[0] == data["repository"]]:
+            self.pending[key]["timer"].cancel()
+            self.flush_update(key)
+        self.submit([method.delivery_tag], data, trace)
+
+    def submit(self, delivery_tags, data, trace):
+        # a repository with tasks already queued or running gets this one
+        # added to its queue, which the worker draining it will get to next.
+        # that way a rename or delete can never overtake an earlier update.
+        trace.submitted = time.monotonic()
+        name = data["repository"]
+        task = (delivery_tags, data, trace)
+        with self.repo_queues_guard:
+            queue = self.repo_queues.get(name)
+            if queue is not None:
+                queue.append(task)
+                return
+            self.repo_queues[name] = collections.deque()
+        self.pool.submit(self.run_repo_tasks, name, task)
+
+    def run_repo_tasks(self, name, task):
+        while task:
+            self.run_task(*task)
+            with self.repo_queues_guard:
+                queue = self.repo_queues[name]
+                if queue:
+                    task = queue.popleft()
+                else:
+                    del self.repo_queues[name]
+                    task = None
+
+    def coalesce_update(self, delivery_tag, data, trace):
+        # updates for the same repository and the same set of remotes are
+        # merged. the newest message wins, except that the merged update is
+        # forced if any of them was. all merged messages are acked together
+        # once the single resulting push is done.
+        remote_for = data.get("remote_for")
+        if remote_for is not None:
+            remote_for = frozenset(remote_for)
+        key = (data["repository"], remote_for)
+
+        entry = self.pending.get(key)
+        if entry:
+            data["attempt"] = min(data["attempt"], entry["data"]["attempt"])
+            if entry["data"].get("force"):
+                data["force"] = True
+            data["refs"] = merge_changes(entry["data"].get("refs"), data.get("refs"))
+            if data["refs"] is None:
+                del data["refs"]
+            entry["trace"].outcome = "superseded"
+            self.write_trace(entry["trace"], entry["data"])
+            entry["data"] = data
+            entry["trace"] = trace
+            entry["tags"].append(delivery_tag)
+            self.log.debug("coalesced update: {}".format(data["repository"]))
+            return
+
+        # flush right away if we are already holding as much as we may
+        if len(self.pending) >= self.coalesce_max_pending:
+            self.submit([delivery_tag], data, trace)
+            return
+
+        timer = threading.Timer(self.coalesce_window, self.threadsafe, (self.flush_update, key))
+        timer.daemon = True
+        self.pending[key] = { "data": data, "tags": [delivery_tag], "timer": timer, "trace": trace }
+        timer.start()
+
+    def flush_update(self, key):
+        entry = self.pending.pop(key, None)
+        if entry:
+            trace = entry["trace"]
+            trace.add("coalesce", trace.start, time.monotonic())
+            self.submit(entry["tags"], entry["data"], trace)
+
+    def parse_message(self, body):
         if type(body) is bytes:
             body = body.decode("utf-8")
         try:
             data = json.loads(body)
         except json.JSONDecodeError:
             self.log.error("task malformed: {}".format(body))
-            channel.basic_ack(method.delivery_tag)
-            return
+            return None
 
         # check the retry count
         if not data.get("attempt"):
@@ -118,117 +351,231 @@ class SlaveCore(object):
         remote_for = data.get("remote_for")
         if (remote_for is not None) and (self.slave_name not in remote_for):
             self.log.debug("skipped conditional task not meant for this slave: {}".format(body))
-            channel.basic_ack(method.delivery_tag)
-            return
+            return None
 
         # check for existence and validity of method
         valid_ops = ("create", "rename", "update", "delete", "syncdesc")
         op = data.get("operation")
         if (not op) or (op not in valid_ops):
             self.log.error("task malformed: invalid or no operation: {}".format(body))
-            channel.basic_ack(method.delivery_tag)
-            return
+            return None
 
         # check for source repo in message
         repo = data.get("repository")
         if not repo:
             self.log.error("task malformed: no repository: {}".format(body))
-            channel.basic_ack(method.delivery_tag)
-            return
+            return None
 
         # check if the repo can be handled by this repo
         if not self.remote.can_handle_repo(repo):
             self.log.debug("repository cannot be handled by this repo, skipping: {}".format(body))
-            channel.basic_ack(method.delivery_tag)
-            return
+            return None
+        return data
+
+    def run_task(self, delivery_tags, data, trace):
+        trace.add("queue_wait", trace.submitted, time.monotonic())
+        self.m_in_flight.inc()
+        if (not data["attempt"]) and data.get("queued_at"):
+            self.m_queue_latency.observe(max(0, time.time() - data["queued_at"]))
+        try:
+            with tracing.activate(trace):
+                self.process_task(data)
+        except Exception:
+            trace.outcome = "error"
+            self.log.error("task failed unexpectedly: {}".format(json.dumps(data)))
+            self.log.exception()
+        finally:
+            self.m_in_flight.dec()
+            self.threadsafe(self.finish_task, delivery_tags, data, trace)
+
+    def finish_task(self, delivery_tags, data, trace):
+        # runs on the connection thread
+        with trace.span("ack"):
+            for tag in delivery_tags:
+                self.channel.basic_ack(tag)
+        self.write_trace(trace, data)
+
+    def process_task(self, data):
+        # a retried update is pointless if a newer update for the same
+        # repository has gone through since this attempt last started
+        op = data.get("operation")
+        name = data.get("repository")
+        if (op == "update") and data["attempt"] and (not data.get("force")):
+            if self.refcache.synced_at(name) > data.get("started_at", 0):
+                self.opslog.info("dropping stale retry of repository update: {}".format(name))
+                self.count_outcome(op, "dropped")
+                return
 
         # check if the source repo is valid and exists
-        repo = self.get_repo(repo)
+        with tracing.span("get_repo"):
+            repo = self.get_repo(name)
         if not repo and op != "delete":
-            self.log.error("invalid repository: {}".format(body))
-            channel.basic_ack(method.delivery_tag)
+            self.log.error("invalid repository: {}".format(json.dumps(data)))
+            self.count_outcome(op, "invalid")
             return
 
-        ret = getattr(self, "process_op_{}".format(op))(data, repo)
-        if ret is False:
-            data["attempt"] = data["attempt"] + 1
-            if data["attempt"] > self.max_retries:
-                self.fail_permanently(data)
-            else:
-                message = json.dumps(data)
-                backoff = str(self.retry_step * data["attempt"])
-                self.channel.basic_publish(
-                    exchange = "",
-                    routing_key = amqp.delay_queue_name_for_slave(self.slave_name),
-                    properties = pika.BasicProperties(expiration = backoff),
-                    body = message
-                )
-        channel.basic_ack(method.delivery_tag)
+        data["started_at"] = time.time()
+        try:
+            with tracing.span("op.{}".format(op)):
+                ret = getattr(self, "process_op_{}".format(op))(data, repo)
+        except DeferTask as e:
+            # the remote asked us to come back later, this is not a failure
+            self.opslog.info("deferring {} of {} by {:.0f} seconds: {}".format(op, name, e.delay, e))
+            self.m_deferrals.inc(operation = op)
+            self.count_outcome(op, "deferred")
+            self.schedule_retry(data, int(e.delay * 1000))
+            return
+        finally:
+            self.m_duration.observe(time.time() - data["started_at"], operation = op)
+
+        # operations return nothing when they succeed, and a failure class
+        # (or just False, for a transient failure) when they don't
+        error = retry.TRANSIENT if ret is False else ret
+        if not error:
+            data.pop("error_class", None)
+            self.count_outcome(op, "success")
+            return
+        self.count_outcome(op, "failure")
+        self.handle_failure(data, error)
+
+    def handle_failure(self, data, error):
+        op = data.get("operation")
+        name = data.get("repository")
+        data["error_class"] = error
+        self.m_errors.inc(operation = op, **{ "class": error })
+
+        # a rate limit without a hint of how long to wait is backed off from
+        # like anything else, but it doesn't use up the retries
+        if error == retry.RATELIMIT:
+            data["deferrals"] = data.get("deferrals", 0) + 1
+            self.m_deferrals.inc(operation = op)
+            self.schedule_retry(data, self.retry.backoff(data["deferrals"]))
+            return
+
+        data["attempt"] = data["attempt"] + 1
+        delay = self.retry.delay_for(error, data["attempt"])
+        if delay is None:
+            self.opslog.error("giving up on {} of {} after {} attempts ({} failure)".format(op, name, data["attempt"], error))
+            self.fail_permanently(data)
+            return
+        self.opslog.info("retrying {} of {} in {:.0f} seconds ({} failure)".format(op, name, delay / 1000, error))
+        self.m_retries.inc(attempt = data["attempt"])
+        self.schedule_retry(data, delay)
+
+    def schedule_retry(self, data, delay):
+        # park the message in the delay queue for the shortest backoff level
+        # it fits in. the per-message expiry brings it back earlier than the
+        # level's ttl, unless it's stuck behind a longer wait in that level.
+        level = self.retry.level_for(delay)
+        message = json.dumps(data)
+        self.threadsafe(self.channel.basic_publish,
+            exchange = "",
+            routing_key = amqp.delay_level_queue_name(self.slave_name, level),
+            properties = pika.BasicProperties(expiration = str(max(1, min(delay, level)))),
+            body = message
+        )
+
+    def threadsafe(self, func, *args, **kwargs):
+        # pika channels may only be used from the thread that runs the
+        # connection, so worker threads queue their calls onto it
+        callback = functools.partial(func, *args, **kwargs)
+        self.channel.connection.add_callback_threadsafe(callback)
 
     def process_op_create(self, data, repo):
         name = data.get("repository")
         try:
             self.remote.create(name, repo.description)
-        except Exception:
+        except DeferTask:
+            raise
+        except Exception as e:
             self.opslog.error("could not create repository: {}".format(name))
             self.opslog.exception()
-            return False
+            return retry.classify(e)
         self.opslog.info("created repository: {}".format(name))
 
     def process_op_rename(self, data, repo):
         name = data.get("repository")
         dest = data.get("destination")
         if not dest:
-            self.log.error("task malformed: no destination: {}".format(body))
+            self.log.error("task malformed: no destination: {}".format(json.dumps(data)))
             return
         try:
+            self.refcache.invalidate(name)
+            self.refcache.invalidate(dest)
+            self.handles.discard(os.path.join(self.repobase, name))
             self.remote.rename(name, dest)
-        except Exception:
+        except DeferTask:
+            raise
+        except Exception as e:
             self.opslog.error("could not create repository: {}".format(name))
             self.opslog.exception()
-            return False
+            return retry.classify(e)
         self.opslog.info("renamed repository: {} -> {}".format(name, dest))
 
     def process_op_update(self, data, repo):
         name = data.get("repository")
-        if not repo.branches:
+        if not repo.has_branches:
             self.opslog.info("skipping update of empty repository: {}".format(name))
             return
+
+        # skip the push entirely if nothing changed since the last good sync
+        with tracing.span("refcache"):
+            current = self.refcache.is_current(name, repo.ref_digest)
+        if (not data.get("force")) and current:
+            self.opslog.info("skipping update of unchanged repository: {}".format(name))
+            return
+        refs = repo.refs()
+
+        # a message that says which refs changed only needs those pushed, as
+        # long as the mirror is known to have been in sync before the change
+        changes = data.get("refs")
+        if (changes is not None) and (data.get("force") or not self.refcache.covers(name, refs, changes)):
+            changes = None
+
         try:
-            self.remote.update(repo, name)
-        except Exception:
+            ret = self.remote.update(repo, name, changes)
+        except DeferTask:
+            self.refcache.invalidate(name)
+            raise
+        except Exception as e:
+            self.refcache.invalidate(name)
             self.opslog.error("could not update repository: {}".format(name))
             self.opslog.exception()
+            return retry.classify(e)
+        if ret is False:
+            self.refcache.invalidate(name)
+            self.opslog.error("could not update repository: {}".format(name))
             return False
+        self.refcache.set(name, refs, data.get("started_at"))
         self.opslog.info("updated repository: {}".format(name))
 
     def process_op_delete(self, data, repo):
         name = data.get("repository")
         try:
+            self.refcache.invalidate(name)
             self.remote.delete(name)
-        except Exception:
+        except DeferTask:
+            raise
+        except Exception as e:
             self.opslog.error("could not delete repository: {}".format(name))
             self.opslog.exception()
-            return False
+            return retry.classify(e)
         self.opslog.info("deleted repository: {}".format(name))
 
     def process_op_syncdesc(self, data, repo):
         name = data.get("repository")
         try:
             self.remote.setdesc(name, repo.description)
-        except Exception:
+        except DeferTask:
+            raise
+        except Exception as e:
             self.opslog.error("could not sync repository description: {}".format(name))
             self.opslog.exception()
-            return False
+            return retry.classify(e)
         self.opslog.info("synced repository description: {}".format(name))
 
     def get_repo(self, repo):
-        path = os.path.join(self.repobase, repo)
-        try:
-            repo = git.Repo(path)
-        except (git.exc.NoSuchPathError, git.exc.InvalidGitRepositoryError):
-            return None
-        return repo
+        return self.handles.get(os.path.join(self.repobase, repo))
 
     def fail_permanently(self, data):
-        pass
+        self.m_failures.inc(operation = data.get("operation"))
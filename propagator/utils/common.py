@@ -27,8 +27,12 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
 # THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import git
 import os
+import sys
+import time
+import re
+import shlex
+import pika
 
 try:
     import simplejson as json
@@ -36,6 +40,8 @@ except ImportError:
     import json
 
 from propagator.core.config import config_general
+from propagator.core.catalog import catalog
+from propagator.core.tracing import new_trace_id
 from propagator.remoteslave import amqp
 
 # Data First
@@ -44,28 +50,156 @@ allowed_ops = ("create", "update", "rename", "delete", "syncdesc")
 
 # Methods
 
-def send_message(payload):
+def publish(channel, payload):
+    # a message meant for several remotes is published once for each of them
+    payload.setdefault("queued_at", time.time())
+    payload.setdefault("trace_id", new_trace_id())
     body = json.dumps(payload)
+    try:
+        for key in amqp.routing_keys(payload):
+            ret = channel.basic_publish(
+                exchange = amqp.exchange_name(),
+                routing_key = key,
+                body = body
+            )
+            if ret is False:
+                return False
+    except pika.exceptions.AMQPError:
+        return False
+    return True
+
+def close_channel(channel):
+    try:
+        channel.connection.close()
+    except pika.exceptions.AMQPError:
+        pass
+
+def send_message(payload):
     channel = amqp.create_channel_producer()
-    return channel.basic_publish(
-        exchange = amqp.exchange_name(),
-        routing_key = "",
-        body = body
-    )
+    try:
+        return publish(channel, payload)
+    finally:
+        close_channel(channel)
+
+def send_messages(payloads):
+    # publish everything over one connection, and have the broker confirm
+    # every message so that we can tell exactly which ones made it
+    try:
+        channel = amqp.create_channel_producer()
+    except pika.exceptions.AMQPError:
+        return [False] * len(payloads)
+    try:
+        channel.confirm_delivery()
+        return [publish(channel, i) for i in payloads]
+    finally:
+        close_channel(channel)
+
+def read_batch(path):
+    # one entry per line, blank lines and comments are skipped
+    f = sys.stdin if (path == "-") else open(path)
+    try:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def parse_operation(line):
+    # a batch line is either a full message as a json object, or of the form
+    # "action reponame [argument]", where the argument is the destination of
+    # a rename or the new description for syncdesc
+    if line.startswith("{"):
+        try:
+            return json.loads(line)
+        except ValueError:
+            return line
+    try:
+        parts = shlex.split(line)
+    except ValueError:
+        return line
+    message = { "operation": parts[0], "repository": parts[1] if len(parts) > 1 else None }
+    if len(parts) > 2:
+        if parts[0] == "rename":
+            message["destination"] = parts[2]
+        elif parts[0] == "syncdesc":
+            message["description"] = parts[2]
+    return message
+
+is_object_name = lambda sha: bool(re.match(r"^([0-9a-f]{40}|[0-9a-f]{64})$", sha or ""))
+
+def parse_ref_update(line):
+    # a post-receive style "old new ref" line, as a ref change
+    parts = line.split()
+    if len(parts) != 3:
+        return line
+    return { "old": parts[0], "new": parts[1], "ref": parts[2] }
+
+def validate_refs(refs):
+    if not isinstance(refs, list):
+        return "refs is not a list"
+    for change in refs:
+        if not isinstance(change, dict):
+            return "invalid ref update: {}".format(change)
+        if not (is_object_name(change.get("old")) and is_object_name(change.get("new"))):
+            return "invalid object name in ref update: {}".format(change)
+        if not str(change.get("ref", "")).startswith("refs/"):
+            return "invalid ref name in ref update: {}".format(change)
+    return None
+
+def validate_message(message):
+    # returns an error string for an invalid message, or None
+    if not isinstance(message, dict):
+        return "not a message"
+    if message.get("operation") not in allowed_ops:
+        return "invalid operation: {}".format(message.get("operation"))
+    if (not message.get("repository")) or (not isinstance(message["repository"], str)):
+        return "no repository"
+    if (message["operation"] == "rename") and not isinstance(message.get("destination"), str):
+        return "rename requires a destination"
+    if (message["operation"] == "update") and ("refs" in message):
+        error = validate_refs(message["refs"])
+        if error:
+            return error
+    if (message["operation"] in ("update", "syncdesc")) and not is_valid_repo(message["repository"]):
+        return "not a valid repository"
+    return None
+
+def send_batch(messages):
+    # validate and publish a batch of messages, and report on each of them
+    valid = []
+    failed = 0
+    for message in messages:
+        error = validate_message(message)
+        if (not error) and (message["operation"] == "syncdesc") and ("description" in message):
+            if not set_local_desc(message["repository"], message.pop("description")):
+                error = "unable to set description on the local repository"
+        if error:
+            print("INVALID: {}: {}".format(message, error), file = sys.stderr)
+            failed = failed + 1
+            continue
+        message.setdefault("attempt", 0)
+        valid.append(message)
+
+    results = send_messages(valid) if valid else []
+    for message, ret in zip(valid, results):
+        if ret:
+            print("OK: {} {}".format(message["operation"], message["repository"]))
+        else:
+            print("FAILED: {} {}".format(message["operation"], message["repository"]), file = sys.stderr)
+            failed = failed + 1
+
+    print("{} sent, {} failed".format(results.count(True), failed))
+    return (failed == 0)
 
 def is_valid_repo(repo):
     path = os.path.join(config_general.get("repobase"), repo)
-    try:
-        repo = git.Repo(path)
-    except (git.exc.NoSuchPathError, git.exc.InvalidGitRepositoryError):
-        return False
-    return True
+    return (catalog().lookup(path) is not None)
 
 def set_local_desc(repo, desc):
     path = os.path.join(config_general.get("repobase"), repo)
-    repo = git.Repo(path)
     try:
-        repo.description = desc
+        return catalog().set_description(path, desc)
     except Exception:
         return False
-    return True
@@ -0,0 +1,100 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2016 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# A tiny client for propagator-producerd, meant to be called from git hooks.
+# It only hands the message over to the daemon, and spools it to disk if the
+# daemon cannot be reached.
+
+import os
+import sys
+import time
+import uuid
+import socket
+import argparse
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from propagator.utils.spool import DEFAULT_SOCKET, DEFAULT_SPOOL, spool_append
+
+def cmdline_process():
+    parser = argparse.ArgumentParser(description = "Queue a repository update with the local Propagator producer")
+    parser.add_argument("reponame", type = str, help = "the name of the repository to update")
+    parser.add_argument("remote", type = str, nargs = "*", help = "update only these remotes")
+    parser.add_argument("-s", "--socket", type = str, default = DEFAULT_SOCKET, help = "the socket the producer listens on")
+    parser.add_argument("-S", "--spool", type = str, default = DEFAULT_SPOOL, help = "the spool directory to fall back to")
+    parser.add_argument("-t", "--timeout", type = float, default = 2.0, help = "seconds to wait for the producer")
+    parser.add_argument("-v", "--verbose", action = "store_true", help = "give verbose output on the standard output")
+    return parser.parse_args()
+
+def send(path, message, timeout):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(os.path.expanduser(path))
+        sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+        reply = sock.makefile("rb").readline().decode("utf-8").strip()
+    finally:
+        sock.close()
+    return reply
+
+def update_message(reponame, remotes = None, refs = None):
+    message = { "operation": "update", "repository": reponame, "attempt": 0, "queued_at": time.time(), "trace_id": uuid.uuid4().hex }
+    if remotes:
+        message["remote_for"] = list(remotes)
+    if refs:
+        message["refs"] = list(refs)
+    return message
+
+def enqueue(message, path = DEFAULT_SOCKET, spooldir = DEFAULT_SPOOL, timeout = 2.0):
+    # hand the message to the producer, and return its reply. if the producer
+    # is down, leave the message for it to replay later and return None.
+    try:
+        return send(path, message, timeout)
+    except OSError:
+        spool_append(spooldir, (message,))
+        return None
+
+def main():
+    args = cmdline_process()
+    message = update_message(args.reponame, args.remote)
+    reply = enqueue(message, args.socket, args.spool, args.timeout)
+    if reply is None:
+        if args.verbose:
+            print("Propagator producer unavailable, update spooled for later")
+        sys.exit(0)
+
+    if reply != "OK":
+        print("ERROR: {}".format(reply), file = sys.stderr)
+        sys.exit(1)
+    if args.verbose:
+        print("Successfully notified Propagator to update repository mirrors")
+    sys.exit(0)
@@ -0,0 +1,204 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2016 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Repository maintenance for the repositories Propagator pushes from, and for
+# the mirrors on anongit hosts. Every repository is looked at on each pass,
+# and only gets the work its state calls for: a full repack with a bitmap
+# when loose objects or packs pile up, with the unreachable objects kept in a
+# cruft pack until they're older than prune_expire, a fresh commit-graph when
+# it's missing or older than the packs, and packed refs when loose refs pile
+# up or have been left unpacked for too long.
+
+import os
+import sys
+import time
+import glob
+import fcntl
+import shutil
+import argparse
+import subprocess
+import concurrent.futures
+
+from propagator.core.config import config_general, config_maintenance
+from propagator.core.catalog import find_repos
+
+LOCK_NAME = "propagator-maintenance.lock"
+STAMP_NAME = "propagator-maintenance.stamp"
+
+def loose_objects(gitdir):
+    # estimate the loose object count from one fan-out directory, like
+    # git gc --auto does
+    try:
+        return len(os.listdir(os.path.join(gitdir, "objects", "17"))) * 256
+    except FileNotFoundError:
+        return 0
+
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return 0
+
+def repo_state(gitdir):
+    # kept packs and the cruft pack of unreachable objects are left as they are
+    packs = [i for i in glob.glob(os.path.join(gitdir, "objects", "pack", "*.pack"))
+        if not (os.path.exists(i[:-5] + ".keep") or os.path.exists(i[:-5] + ".mtimes"))]
+    loose_refs = 0
+    for root, dirs, files in os.walk(os.path.join(gitdir, "refs")):
+        loose_refs = loose_refs + sum(1 for i in files if not i.endswith(".lock"))
+    graph = max(mtime(os.path.join(gitdir, "objects", "info", "commit-graph")),
+        mtime(os.path.join(gitdir, "objects", "info", "commit-graphs", "commit-graph-chain")))
+    return {
+        "loose": loose_objects(gitdir),
+        "packs": len(packs),
+        "bitmap": bool(glob.glob(os.path.join(gitdir, "objects", "pack", "*.bitmap"))),
+        "newest_pack": max([mtime(i) for i in packs] or [0]),
+        "commit_graph": graph,
+        "loose_refs": loose_refs,
+        "packed_refs": mtime(os.path.join(gitdir, "packed-refs")),
+    }
+
+def plan(state, limits, now):
+    tasks = []
+    if (not state["packs"]) and (not state["loose"]) and (not state["loose_refs"]):
+        return tasks
+    repack = (state["loose"] > limits["loose"]) or (state["packs"] > limits["packs"])
+    repack = repack or (state["packs"] and not state["bitmap"])
+    if repack:
+        tasks.append("repack")
+    if repack or (state["commit_graph"] < state["newest_pack"]):
+        tasks.append("commit-graph")
+    stale = now - (state["packed_refs"] or 0) > limits["refs_age"]
+    if (state["loose_refs"] > limits["refs"]) or (state["loose_refs"] and stale):
+        tasks.append("pack-refs")
+    return tasks
+
+def task_command(task, args):
+    return {
+        # unreachable objects are kept rather than dropped, since a push in
+        # progress may have brought them in without a ref on them yet. They go
+        # into a cruft pack instead of being left loose, where they would
+        # count towards the loose limit again and set off another full repack
+        # on every pass until they expired.
+        "repack": ("repack", "--cruft", "--cruft-expiration={}".format(args.prune_expire), "-d", "-q", "--write-bitmap-index"),
+        "commit-graph": ("commit-graph", "write", "--reachable"),
+        "pack-refs": ("pack-refs", "--all", "--prune"),
+    }[task]
+
+def wait_for_quiet(max_load):
+    # hold back new work while the machine is busy serving
+    while max_load and (os.getloadavg()[0] > max_load):
+        time.sleep(5)
+
+def maintain(repobase, name, args, limits):
+    # returns (name, tasks done, error)
+    gitdir = os.path.join(repobase, name)
+    lockpath = os.path.join(gitdir, LOCK_NAME)
+    stamppath = os.path.join(gitdir, STAMP_NAME)
+
+    # the stamp is only touched when every task succeeded, so a repository
+    # that failed is tried again on the next pass
+    now = time.time()
+    if now - mtime(stamppath) < args.min_interval:
+        return (name, [], None)
+    tasks = plan(repo_state(gitdir), limits, now)
+    if (not tasks) or args.dry_run:
+        return (name, tasks, None)
+
+    wait_for_quiet(args.max_load)
+    with open(lockpath, "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return (name, [], None)
+        prefix = ("ionice", "-c", "3") if shutil.which("ionice") else ()
+        for task in tasks:
+            p = subprocess.run(prefix + ("git", "--git-dir", gitdir) + task_command(task, args),
+                stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+            if p.returncode:
+                return (name, tasks[:tasks.index(task)], "{} failed: {}".format(task, p.stderr.decode("utf-8", "replace").strip()))
+        with open(stamppath, "a"):
+            os.utime(stamppath)
+    return (name, tasks, None)
+
+def run_pass(repobase, args, limits):
+    done = failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers = args.jobs) as pool:
+        futures = [pool.submit(maintain, repobase, name, args, limits) for name in find_repos(repobase)]
+        for future in concurrent.futures.as_completed(futures):
+            name, tasks, error = future.result()
+            if error:
+                failed = failed + 1
+                print("ERROR: {}: {}".format(name, error), file = sys.stderr)
+            elif tasks:
+                done = done + 1
+                if args.verbose or args.dry_run:
+                    print("{}: {}".format(name, ", ".join(tasks)))
+    if args.verbose:
+        print("{} repositories {}, {} failed".format(done, "need maintenance" if args.dry_run else "maintained", failed))
+    return failed == 0
+
+def cmdline_process():
+    parser = argparse.ArgumentParser(description = "Repack and pack refs in the repositories that need it")
+    parser.add_argument("-r", "--repobase", type = str, help = "maintain the repositories under this directory instead of the configured repobase")
+    parser.add_argument("-a", "--agent", action = "store_true", help = "maintain the repositories served by propagator-agent on this host")
+    parser.add_argument("-j", "--jobs", type = int, default = int(config_maintenance.get("jobs", 1)), help = "number of repositories to maintain at once")
+    parser.add_argument("-l", "--max-load", type = float, default = float(config_maintenance.get("max_load", os.cpu_count() or 1)), help = "don't start on a repository while the load average is above this (0 to ignore)")
+    parser.add_argument("-i", "--interval", type = int, default = 0, help = "keep running, with a pass every this many seconds")
+    parser.add_argument("--min-interval", type = int, default = int(config_maintenance.get("min_interval", 3600)), help = "leave repositories maintained less than this many seconds ago alone")
+    parser.add_argument("--prune-expire", type = str, default = config_maintenance.get("prune_expire", "2.weeks.ago"), help = "only prune unreachable objects older than this")
+    parser.add_argument("-n", "--dry-run", action = "store_true", help = "only print what would be done")
+    parser.add_argument("-v", "--verbose", action = "store_true", help = "print every repository that is maintained")
+    return parser.parse_args()
+
+def main():
+    args = cmdline_process()
+    if args.agent:
+        from propagator.agent.config import repobase
+        repobase = repobase()
+    else:
+        repobase = os.path.expanduser(args.repobase or config_general.get("repobase", ""))
+    if not os.path.isdir(repobase):
+        print("ERROR: {} is not a directory".format(repobase), file = sys.stderr)
+        sys.exit(1)
+
+    limits = {
+        "loose": int(config_maintenance.get("loose_objects", 1000)),
+        "packs": int(config_maintenance.get("packs", 20)),
+        "refs": int(config_maintenance.get("loose_refs", 100)),
+        "refs_age": int(config_maintenance.get("packed_refs_age", 7 * 86400)),
+    }
+
+    # stay out of the way of the git processes serving real traffic
+    os.nice(int(config_maintenance.get("nice", 10)))
+    while True:
+        ok = run_pass(repobase, args, limits)
+        if not args.interval:
+            sys.exit(0 if ok else 1)
+        time.sleep(args.interval)
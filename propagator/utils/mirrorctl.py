@@ -30,23 +30,34 @@
 import sys
 import argparse
 
-from propagator.utils.common import is_valid_repo, send_message, allowed_ops, set_local_desc
+from propagator.utils.common import is_valid_repo, send_message, allowed_ops, set_local_desc, read_batch, parse_operation, send_batch
 
 def cmdline_process():
     parser = argparse.ArgumentParser(description = "Propagator Mirror Control Utility")
-    parser.add_argument("action", type = str, help = "the action to perform on the repo", choices = allowed_ops)
-    parser.add_argument("reponame", type = str, help = "the name of the repository to update")
+    parser.add_argument("action", type = str, nargs = "?", help = "the action to perform on the repo", choices = allowed_ops)
+    parser.add_argument("reponame", type = str, nargs = "?", help = "the name of the repository to update")
     parser.add_argument("-D", "--dest", type = str, help = "the new name for the renamed repository", required = False)
     parser.add_argument("-d", "--desc", type = str, help = "the new description for the repository", required = False)
+    parser.add_argument("-b", "--batch", type = str, metavar = "FILE", help = "read operations from this file, or - for stdin", required = False)
     parser.add_argument("remote", type = str, nargs = "*", help = "update only these remotes")
 
     args = parser.parse_args()
+    if args.batch:
+        if args.action or args.reponame or args.remote:
+            parser.error("Batch mode does not take an action or repository on the command line")
+        return args
+    if not (args.action and args.reponame):
+        parser.error("An action and a repository name are required")
     if (args.action ==  "rename") and (not args.dest):
         parser.error("The rename action requires a specified restination")
     return args
 
 def main():
     args = cmdline_process()
+    if args.batch:
+        messages = [parse_operation(i) for i in read_batch(args.batch)]
+        sys.exit(0 if send_batch(messages) else 1)
+
     if (args.action == "update") and (not is_valid_repo(args.reponame)):
         print("ERROR: {} is not a valid repository".format(args.reponame), file = sys.stderr)
         sys.exit(1)
@@ -30,24 +30,63 @@
 import sys
 import argparse
 
-from propagator.utils.common import is_valid_repo, send_message
+from propagator.utils.common import is_valid_repo, send_message, read_batch, parse_operation, send_batch
+from propagator.utils.common import parse_ref_update, validate_refs
 
 def cmdline_process():
     parser = argparse.ArgumentParser(description = "Sync updates to all repository mirrors through Propagator")
-    parser.add_argument("reponame", type = str, help = "the name of the repository to update")
+    parser.add_argument("reponame", type = str, nargs = "?", help = "the name of the repository to update")
     parser.add_argument("remote", type = str, nargs = "*", help = "update only these remotes")
+    parser.add_argument("-b", "--batch", type = str, metavar = "FILE", help = "read repository names or json operations from this file, or - for stdin", required = False)
+    parser.add_argument("-r", "--refs", type = str, metavar = "FILE", help = "read post-receive style \"old new ref\" lines from this file, or - for stdin, and only push those refs", required = False)
+    parser.add_argument("-f", "--force", action = "store_true", help = "push even if the mirrors are believed to be up to date")
     parser.add_argument("-v", "--verbose", action = "store_true", help = "give verbose output on the standard output")
     args = parser.parse_args()
+    if bool(args.reponame) == bool(args.batch):
+        parser.error("Specify either a repository name or a batch file")
+    if args.batch and args.remote:
+        parser.error("In batch mode, remotes are given on each line after the repository name")
+    if args.batch and args.refs:
+        parser.error("In batch mode, ref updates are given as json operations")
     return args
 
+def batch_message(line, args):
+    # plain lines are a repository name optionally followed by the remotes to
+    # update, and lines holding a json object are full operations
+    if line.startswith("{"):
+        return parse_operation(line)
+    parts = line.split()
+    message = { "operation": "update", "repository": parts[0], "attempt": 0 }
+    if parts[1:]:
+        message["remote_for"] = parts[1:]
+    if args.force:
+        message["force"] = True
+    return message
+
 def main():
     args = cmdline_process()
+    if args.batch:
+        messages = [batch_message(i, args) for i in read_batch(args.batch)]
+        sys.exit(0 if send_batch(messages) else 1)
+
     if not (is_valid_repo(args.reponame)):
         print("ERROR: {} is not a valid repository".format(args.reponame), file = sys.stderr)
         sys.exit(1)
     message = { "operation": "update", "repository": args.reponame, "attempt": 0 }
     if args.remote:
         message["remote_for"] = args.remote
+    if args.force:
+        message["force"] = True
+    if args.refs:
+        message["refs"] = [parse_ref_update(i) for i in read_batch(args.refs)]
+        error = validate_refs(message["refs"])
+        if error:
+            print("ERROR: {}".format(error), file = sys.stderr)
+            sys.exit(1)
+        if not message["refs"]:
+            if args.verbose:
+                print("No ref updates given, nothing to do")
+            sys.exit(0)
     ret = send_message(message)
     if not ret:
         print("ERROR: Failed to notify Propagator to update repository mirrors")
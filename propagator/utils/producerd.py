@@ -0,0 +1,204 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2016 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import time
+import queue
+import signal
+import logbook
+import argparse
+import threading
+import socketserver
+
+import pika
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from propagator import VERSION as version
+from propagator.core.config import config_producer
+from propagator.remoteslave import amqp
+from propagator.utils.common import publish, close_channel, validate_message
+from propagator.utils.spool import DEFAULT_SOCKET, DEFAULT_SPOOL, spool_append, spool_take, spool_read
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline().decode("utf-8").strip()
+        try:
+            message = json.loads(line)
+        except ValueError:
+            message = None
+
+        try:
+            error = validate_message(message)
+        except (TypeError, ValueError):
+            error = "malformed message"
+        if error:
+            self.wfile.write("{}\n".format(error).encode("utf-8"))
+            return
+
+        # only say OK once the broker has confirmed the message, or it has
+        # been spooled to disk, so that a crash can't lose what we accepted
+        message.setdefault("attempt", 0)
+        item = { "message": message, "done": threading.Event(), "ok": False }
+        self.server.producer.queue.put(item)
+        item["done"].wait()
+        self.wfile.write(b"OK\n" if item["ok"] else b"could not queue the message\n")
+
+class ProducerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class Producer(object):
+    def __init__(self, socket_path, spooldir, replay_interval, connect_timeout = 1.0):
+        self.log = logbook.Logger("Producer-{}".format(str(os.getpid())))
+        self.socket_path = os.path.expanduser(socket_path)
+        self.spooldir = os.path.expanduser(spooldir)
+        self.replay_interval = replay_interval
+        self.connect_timeout = connect_timeout
+        self.broker_down = False
+        self.queue = queue.Queue()
+        self.channel = None
+        self.running = True
+
+    def __call__(self):
+        self.log.info("This is KDE Propagator {} - Producer".format(version))
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = ProducerServer(self.socket_path, RequestHandler)
+        self.server.producer = self
+
+        # the publisher owns the amqp connection, pika is not thread safe
+        publisher = threading.Thread(target = self.publish_loop)
+        publisher.start()
+
+        signal.signal(signal.SIGTERM, signal.getsignal(signal.SIGINT))
+        self.log.info("listening on {}...".format(self.socket_path))
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        self.log.info("producer is shutting down...")
+
+        self.server.server_close()
+        os.unlink(self.socket_path)
+        self.running = False
+        publisher.join()
+
+    def connect(self):
+        # once the broker is found to be down, everything goes straight to the
+        # spool until the next replay tries it again. the handlers wait for
+        # us, so every message must not wait for a connect to time out.
+        if self.channel:
+            return True
+        if self.broker_down:
+            return False
+        try:
+            self.channel = amqp.create_channel_producer(self.connect_timeout)
+            self.channel.confirm_delivery()
+        except pika.exceptions.AMQPError:
+            self.channel = None
+            self.broker_down = True
+            self.log.warning("could not connect to the amqp server, spooling until the next replay")
+            return False
+        self.log.info("connected to the amqp server")
+        return True
+
+    def disconnect(self):
+        if self.channel:
+            close_channel(self.channel)
+            self.channel = None
+
+    def send(self, message):
+        if self.connect() and publish(self.channel, message):
+            return True
+        if self.channel:
+            self.log.warning("could not publish message, the broker may be down")
+        self.disconnect()
+        return False
+
+    def publish_loop(self):
+        next_replay = 0
+        while self.running or not self.queue.empty():
+            try:
+                item = self.queue.get(timeout = 1)
+            except queue.Empty:
+                item = None
+
+            if item is not None:
+                try:
+                    item["ok"] = self.send(item["message"])
+                    if not item["ok"]:
+                        spool_append(self.spooldir, (item["message"],))
+                        item["ok"] = True
+                except OSError as e:
+                    self.log.error("could not spool message: {}".format(e))
+                finally:
+                    item["done"].set()
+            elif self.channel:
+                # keep the connection alive while idle
+                try:
+                    self.channel.connection.process_data_events(time_limit = 0)
+                except pika.exceptions.AMQPError:
+                    self.disconnect()
+
+            now = time.monotonic()
+            if self.running and (now >= next_replay):
+                next_replay = now + self.replay_interval
+                self.replay()
+        self.disconnect()
+
+    def replay(self):
+        self.broker_down = False
+        for path in spool_take(self.spooldir):
+            messages = spool_read(path)
+            for count, message in enumerate(messages):
+                if not self.send(message):
+                    # put back whatever we could not send and try again later
+                    spool_append(self.spooldir, messages[count:])
+                    os.unlink(path)
+                    return
+            self.log.info("replayed {} spooled messages".format(len(messages)))
+            os.unlink(path)
+
+def cmdline_process():
+    parser = argparse.ArgumentParser(description = "Run the local Propagator producer daemon")
+    parser.add_argument("-s", "--socket", type = str, default = config_producer.get("socket", DEFAULT_SOCKET), help = "the socket to listen on")
+    parser.add_argument("-S", "--spool", type = str, default = config_producer.get("spool_dir", DEFAULT_SPOOL), help = "the directory to spool messages to while the broker is down")
+    parser.add_argument("-r", "--replay-interval", type = int, default = int(config_producer.get("replay_interval", 30)), help = "seconds between attempts to replay the spool")
+    parser.add_argument("-t", "--connect-timeout", type = float, default = float(config_producer.get("connect_timeout", 1)), help = "seconds to wait for the broker when connecting")
+    return parser.parse_args()
+
+def main():
+    logbook.StreamHandler(sys.stdout).push_application()
+    args = cmdline_process()
+    producer = Producer(args.socket, args.spool, args.replay_interval, args.connect_timeout)
+    producer()
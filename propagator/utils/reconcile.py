@@ -0,0 +1,154 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2016 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sys
+import git
+import logbook
+import argparse
+import importlib
+import concurrent.futures
+
+from propagator.core.config import config_general
+from propagator.core.catalog import git_dir_for, find_repos
+from propagator.core.refs import read_refs
+from propagator.utils.common import send_messages
+
+# only heads and tags are mirrored, anything else may differ on purpose
+MIRRORED_NAMESPACES = ("refs/heads/", "refs/tags/")
+
+def parse_refs(output):
+    refs = {}
+    for line in output.splitlines():
+        sha, _, name = line.partition("\t" if "\t" in line else " ")
+        if name.startswith(MIRRORED_NAMESPACES) and not name.endswith("^{}"):
+            refs[name] = sha
+    return refs
+
+def local_tips(path):
+    refs = read_refs(git_dir_for(path)[0])
+    return { k: v for k, v in refs.items() if k.startswith(MIRRORED_NAMESPACES) }
+
+def remote_tips(url, env = None):
+    # returns None if the repository does not exist on the remote
+    cmd = git.Git()
+    cmd.update_environment(**(env or {}))
+    try:
+        output = cmd.ls_remote("--heads", "--tags", url)
+    except git.exc.GitCommandError as e:
+        stderr = str(e.stderr).lower()
+        if ("not found" in stderr) or ("does not exist" in stderr) or ("does not appear to be a git repository" in stderr):
+            return None
+        raise
+    return parse_refs(output)
+
+def check_repo(repobase, name, remote):
+    local = local_tips(os.path.join(repobase, name))
+    if not local:
+        return "empty"
+    # a remote may keep several copies, and the worst of them counts. refs
+    # only the remote has are drift too, since the forced update prunes them,
+    # for restricted syncs as much as for mirror pushes.
+    state = "synced"
+    for url in remote.remote_urls(name):
+        remote_refs = remote_tips(url, remote.git_env())
+        if remote_refs is None:
+            return "missing"
+        if remote_refs != local:
+            state = "drifted"
+    return state
+
+def load_remote(name):
+    module = importlib.import_module("propagator.remotes.{}".format(name))
+    return module.Remote(logbook.Logger("reconcile-{}".format(name)))
+
+def cmdline_process():
+    parser = argparse.ArgumentParser(description = "Find repository mirrors that are behind, and queue updates for them")
+    parser.add_argument("remote", type = str, nargs = "+", help = "check the mirrors on these remotes")
+    parser.add_argument("-j", "--jobs", type = int, default = 16, help = "number of repositories to check in parallel")
+    parser.add_argument("-n", "--dry-run", action = "store_true", help = "only report drift, do not queue any updates")
+    parser.add_argument("-v", "--verbose", action = "store_true", help = "print the state of every repository")
+    return parser.parse_args()
+
+def main():
+    logbook.StreamHandler(sys.stderr, level = "WARNING").push_application()
+    args = cmdline_process()
+    repobase = config_general.get("repobase")
+
+    remotes = []
+    for name in args.remote:
+        try:
+            remote = load_remote(name)
+        except ImportError:
+            print("ERROR: remote plugin not found: {}".format(name), file = sys.stderr)
+            sys.exit(1)
+        if not remote.remote_urls(""):
+            print("ERROR: remote {} has no git url to check against".format(name), file = sys.stderr)
+            sys.exit(1)
+        remotes.append(remote)
+
+    # check every repository against every remote that handles it
+    counts = {}
+    messages = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers = args.jobs) as pool:
+        jobs = {}
+        for name in find_repos(repobase):
+            for remote in remotes:
+                if remote.can_handle_repo(name):
+                    jobs[pool.submit(check_repo, repobase, name, remote)] = (name, remote.plugin_name)
+
+        for job in concurrent.futures.as_completed(jobs):
+            name, remote_name = jobs[job]
+            try:
+                state = job.result()
+            except Exception as e:
+                state = "error"
+                print("ERROR: {} on {}: {}".format(name, remote_name, e), file = sys.stderr)
+            counts[state] = counts.get(state, 0) + 1
+            if args.verbose:
+                print("{}: {} on {}".format(state, name, remote_name))
+
+            if state == "missing":
+                messages.append({ "operation": "create", "repository": name, "attempt": 0, "remote_for": [remote_name] })
+            if state in ("missing", "drifted"):
+                messages.append({ "operation": "update", "repository": name, "attempt": 0, "remote_for": [remote_name], "force": True })
+
+    # queue everything over a single connection
+    failed = 0
+    if messages and not args.dry_run:
+        failed = send_messages(messages).count(False)
+
+    print("checked {} repository mirrors".format(sum(counts.values())))
+    for state in ("synced", "drifted", "missing", "empty", "error"):
+        print("  {:8} {}".format(state, counts.get(state, 0)))
+    if args.dry_run:
+        print("dry run, {} messages not queued".format(len(messages)))
+    else:
+        print("queued {} messages, {} failed".format(len(messages) - failed, failed))
+    sys.exit(1 if (failed or counts.get("error")) else 0)
@@ -0,0 +1,92 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2016 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# This module is shared by the producer daemon and the hook client, and must
+# stay cheap to import. Do not pull in GitPython, pika or the core config.
+
+import os
+import glob
+import time
+import fcntl
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+DEFAULT_SOCKET = "~/.propagator/producer.sock"
+DEFAULT_SPOOL = "~/.propagator/spool"
+
+spool_path = lambda spooldir: os.path.join(spooldir, "spool.jsonl")
+
+def _open_locked(path):
+    # the replayer renames the spool away under the lock, so make sure that
+    # the file we hold the lock on is still the one at the path
+    while True:
+        f = open(path, "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()
+
+def spool_append(spooldir, messages):
+    spooldir = os.path.expanduser(spooldir)
+    if not os.path.isdir(spooldir):
+        os.makedirs(spooldir, exist_ok = True)
+    with _open_locked(spool_path(spooldir)) as f:
+        for message in messages:
+            f.write(json.dumps(message))
+            f.write("\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def spool_take(spooldir):
+    # move the current spool aside and return the path of every spool file
+    # that is waiting to be replayed, including ones left over by a crash
+    spooldir = os.path.expanduser(spooldir)
+    path = spool_path(spooldir)
+    if os.path.exists(path):
+        with _open_locked(path) as f:
+            if os.fstat(f.fileno()).st_size:
+                replay = "{}.{}.{}.replay".format(path, os.getpid(), time.time())
+                os.rename(path, replay)
+    return sorted(glob.glob(os.path.join(spooldir, "*.replay")))
+
+def spool_read(path):
+    messages = []
+    with open(path) as f:
+        for line in f:
+            try:
+                messages.append(json.loads(line))
+            except ValueError:
+                pass
+    return messages
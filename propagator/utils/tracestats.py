@@ -0,0 +1,159 @@
+# This file is part of Propagator, a KDE Sysadmin Project
+#
+# Copyright 2016 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import re
+import sys
+import glob
+import time
+import argparse
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def summarise(values, total = None):
+    summary = {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+    if total:
+        summary["share"] = sum(values) / total
+    return summary
+
+def read_traces(paths, args):
+    repo_re = re.compile(args.repository) if args.repository else None
+    since = (time.time() - args.since) if args.since else 0
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if args.operation and (record.get("operation") != args.operation):
+                    continue
+                if args.outcome and (record.get("outcome") != args.outcome):
+                    continue
+                if repo_re and not repo_re.search(record.get("repository") or ""):
+                    continue
+                if record.get("received_at", 0) < since:
+                    continue
+                yield record
+
+def aggregate(records):
+    totals = []
+    stages = {}
+    operations = {}
+    outcomes = {}
+    for record in records:
+        totals.append(record["total"])
+        operations.setdefault(record.get("operation"), []).append(record["total"])
+        outcomes[record.get("outcome")] = outcomes.get(record.get("outcome"), 0) + 1
+        for span in record.get("spans", ()):
+            stages.setdefault(span["name"], []).append(span["duration"])
+
+    # nested spans overlap, so their shares of the total can add up to more
+    # than the whole
+    grand_total = sum(totals)
+    return {
+        "traces": len(totals),
+        "total": summarise(totals) if totals else None,
+        "stages": { k: summarise(v, grand_total) for k, v in stages.items() },
+        "operations": { str(k): summarise(v) for k, v in operations.items() },
+        "outcomes": { str(k): v for k, v in outcomes.items() },
+    }
+
+def print_table(title, rows):
+    print(title)
+    print("  {:28} {:>7} {:>10} {:>10} {:>10} {:>10} {:>7}".format("", "count", "p50 ms", "p90 ms", "p99 ms", "max ms", "share"))
+    for name, s in sorted(rows.items(), key = lambda i: -i[1]["mean"] * i[1]["count"]):
+        share = "{:6.1f}%".format(s["share"] * 100) if "share" in s else "-"
+        print("  {:28} {:7} {:10.2f} {:10.2f} {:10.2f} {:10.2f} {:>7}".format(
+            name, s["count"], s["p50"] * 1000, s["p90"] * 1000, s["p99"] * 1000, s["max"] * 1000, share))
+    print("")
+
+def cmdline_process():
+    parser = argparse.ArgumentParser(description = "Break down remote slave latency by stage from the trace logs")
+    parser.add_argument("logs", type = str, nargs = "*", help = "trace logs to read (default: all slave trace logs in logs_dir)")
+    parser.add_argument("-o", "--operation", type = str, help = "only include this operation")
+    parser.add_argument("-O", "--outcome", type = str, help = "only include traces with this outcome")
+    parser.add_argument("-r", "--repository", type = str, help = "only include repositories matching this regex")
+    parser.add_argument("-s", "--since", type = float, help = "only include messages received in the last this many seconds")
+    parser.add_argument("-n", "--slowest", type = int, default = 0, help = "also list this many of the slowest traces")
+    parser.add_argument("-j", "--json", action = "store_true", help = "print the breakdown as json")
+    return parser.parse_args()
+
+def main():
+    args = cmdline_process()
+    paths = args.logs
+    if not paths:
+        # the config is only read when it's needed, so that the benchmarks can
+        # share percentile() without loading it from the wrong HOME
+        from propagator.core.config import config_general
+        logdir = os.path.expanduser(config_general.get("logs_dir", "~/.propagator/logs"))
+        paths = sorted(glob.glob(os.path.join(logdir, "remote.*.trace.jsonl")))
+    if not paths:
+        print("ERROR: no trace logs found", file = sys.stderr)
+        sys.exit(1)
+
+    records = list(read_traces(paths, args))
+    result = aggregate(records)
+    slowest = sorted(records, key = lambda r: -r["total"])[:args.slowest]
+
+    if args.json:
+        result["slowest"] = slowest
+        print(json.dumps(result, indent = 4, sort_keys = True))
+        sys.exit(0)
+
+    print("{} traces".format(result["traces"]))
+    if not result["traces"]:
+        sys.exit(0)
+    print("outcomes: {}".format(", ".join("{} {}".format(v, k) for k, v in sorted(result["outcomes"].items()))))
+    print("")
+    print_table("by operation", result["operations"])
+    print_table("by stage", result["stages"])
+    for record in slowest:
+        print("{} {:.3f}s {} {} ({})".format(record["trace_id"], record["total"], record.get("operation"), record.get("repository"), record.get("outcome")))
+        for span in sorted(record.get("spans", ()), key = lambda s: s["start"]):
+            print("    {:>10.2f} ms  +{:<10.2f} {}".format(span["duration"] * 1000, span["start"] * 1000, span["name"]))
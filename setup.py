@@ -26,9 +26,15 @@ setup(
     entry_points     = {
         "console_scripts": (
             "propagator-agent = propagator.agent:main",
+            "propagator-agent-packcache = propagator.agent.packcache:main",
             "propagator-remoteslave = propagator.remoteslave:main",
             "propagator-mirrorsync = propagator.utils.mirrorsync:main",
-            "propagator-mirrorctl = propagator.utils.mirrorctl:main"
+            "propagator-mirrorctl = propagator.utils.mirrorctl:main",
+            "propagator-reconcile = propagator.utils.reconcile:main",
+            "propagator-maintain = propagator.utils.maintain:main",
+            "propagator-tracestats = propagator.utils.tracestats:main",
+            "propagator-producerd = propagator.utils.producerd:main",
+            "propagator-enqueue = propagator.utils.enqueue:main"
         ),
     },
 )
@@ -0,0 +1,173 @@
+# This file is part of Propagator, a KDE project
+#
+# Copyright 2016 Boudhayan Gupta <bgupta@kde.org>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of KDE e.V. (or its successor approved by the
+#    membership of KDE e.V.) nor the names of its contributors may be used
+#    to endorse or promote products derived from this software without
+#    specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The anongit remote plugin against a fleet of local stand-in hosts. Each
+# host is a directory with its own home and repositories. anongitctl runs
+# the real agent through a stand-in for ssh, and pushes go to the hosts'
+# bare repositories over file:// urls.
+
+import os
+import sys
+import json
+import shutil
+import logbook
+import tempfile
+import unittest
+import unittest.mock
+
+from benchmarks.harness import git, make_repo, add_commit
+from propagator.remotes import anongit
+from propagator.utils import reconcile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOSTS = ("host1", "host2")
+
+FAKE_SSH = """#!{python}
+# runs the command given to "ssh host command" as the agent on that host
+import os, sys
+host, command = sys.argv[-2], sys.argv[-1]
+os.environ["HOME"] = os.path.join({base!r}, host)
+os.environ["SSH_ORIGINAL_COMMAND"] = command
+sys.path.insert(0, {root!r})
+from propagator.agent import main
+main()
+"""
+
+class AnongitTest(unittest.TestCase):
+    def setUp(self):
+        self.base = tempfile.mkdtemp(prefix = "propagator-test-")
+        self.addCleanup(shutil.rmtree, self.base, ignore_errors = True)
+
+        for host in HOSTS:
+            os.makedirs(os.path.join(self.base, host, ".propagator"))
+            os.makedirs(os.path.join(self.base, host, "repositories"))
+            with open(os.path.join(self.base, host, ".propagator", "anongit.cfg"), "w") as f:
+                f.write("[anongit]\nrepobase={}\n".format(os.path.join(self.base, host, "repositories")))
+
+        ssh = os.path.join(self.base, "ssh")
+        with open(ssh, "w") as f:
+            f.write(FAKE_SSH.format(python = sys.executable, base = self.base, root = ROOT))
+        os.chmod(ssh, 0o755)
+
+        home = os.path.join(self.base, "slave")
+        os.makedirs(os.path.join(home, ".propagator"))
+        with open(os.path.join(home, ".propagator", "remotes_anongit.json"), "w") as f:
+            json.dump({
+                "hosts": HOSTS,
+                "url": "file://" + os.path.join(self.base, "{host}", "repositories", "{name}"),
+                "ssh_command": [ssh],
+            }, f)
+
+        self.repobase = os.path.join(self.base, "repos")
+        make_repo(os.path.join(self.repobase, "test.git"), commits = 5, branches = 2, tags = 2, blob_size = 64)
+
+        patches = (
+            unittest.mock.patch.dict(os.environ, { "HOME": home }),
+            unittest.mock.patch.object(anongit, "config_general", { "repobase": self.repobase }),
+            unittest.mock.patch.object(anongit, "transport", lambda: None),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.remote = anongit.Remote(logbook.Logger("test"))
+        self.addCleanup(self.remote.pool.shutdown)
+
+    def mirror(self, host, name = "test.git"):
+        return os.path.join(self.base, host, "repositories", name)
+
+    def refs(self, path):
+        return git("for-each-ref", "--format=%(refname) %(objectname)", cwd = path)
+
+    def test_create_update_delete(self):
+        self.assertTrue(self.remote.create("test.git", "a test repository"))
+        for host in HOSTS:
+            with open(os.path.join(self.mirror(host), "description")) as f:
+                self.assertEqual(f.read().strip(), "a test repository")
+
+        # creating a repository that exists everywhere already is fine, and
+        # still sets the description
+        self.assertTrue(self.remote.create("test.git", "a new description"))
+        for host in HOSTS:
+            with open(os.path.join(self.mirror(host), "description")) as f:
+                self.assertEqual(f.read().strip(), "a new description")
+
+        src = os.path.join(self.repobase, "test.git")
+        self.assertTrue(self.remote.update(None, "test.git"))
+        for host in HOSTS:
+            self.assertEqual(self.refs(self.mirror(host)), self.refs(src))
+
+        # a push of just the ref that moved
+        old = git("rev-parse", "refs/heads/master", cwd = src)
+        new = add_commit(src)
+        changes = [{ "old": old, "new": new, "ref": "refs/heads/master" }]
+        self.assertTrue(self.remote.update(None, "test.git", changes))
+        for host in HOSTS:
+            self.assertEqual(git("rev-parse", "refs/heads/master", cwd = self.mirror(host)), new)
+
+        # the pushes must not have changed the slave's own environment
+        self.assertNotIn("GIT_SSH_COMMAND", os.environ)
+
+        self.assertTrue(self.remote.delete("test.git"))
+        for host in HOSTS:
+            self.assertFalse(os.path.exists(self.mirror(host)))
+        self.assertTrue(self.remote.delete("test.git"))
+
+    def test_rename_is_idempotent(self):
+        self.remote.create("test.git")
+
+        # a rename that went through on one host before failing elsewhere
+        os.rename(self.mirror(HOSTS[0]), self.mirror(HOSTS[0], "renamed.git"))
+        self.assertTrue(self.remote.rename("test.git", "renamed.git"))
+        self.assertTrue(self.remote.rename("test.git", "renamed.git"))
+        for host in HOSTS:
+            self.assertFalse(os.path.exists(self.mirror(host)))
+            self.assertTrue(os.path.isdir(self.mirror(host, "renamed.git")))
+
+        # but a source that is missing with no destination is still an error
+        with self.assertRaises(anongit.AnongitError):
+            self.remote.rename("test.git", "other.git")
+
+    def test_reconcile_checks_every_host(self):
+        self.assertEqual(reconcile.check_repo(self.repobase, "test.git", self.remote), "missing")
+        self.remote.create("test.git")
+        self.remote.update(None, "test.git")
+        self.assertEqual(reconcile.check_repo(self.repobase, "test.git", self.remote), "synced")
+
+        # drift on any host but the first still shows
+        git("update-ref", "-d", "refs/heads/master", cwd = self.mirror(HOSTS[1]))
+        self.assertEqual(reconcile.check_repo(self.repobase, "test.git", self.remote), "drifted")
+
+    def test_failure_on_one_host(self):
+        # a host that can't create the repository fails the whole operation
+        shutil.rmtree(os.path.join(self.base, HOSTS[1], "repositories"))
+        with open(os.path.join(self.base, HOSTS[1], "repositories"), "w") as f:
+            f.write("not a directory\n")
+        with self.assertRaises(anongit.AnongitError):
+            self.remote.create("test.git")
+        self.assertTrue(os.path.isdir(self.mirror(HOSTS[0])))